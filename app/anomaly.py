@@ -0,0 +1,138 @@
+import math
+import os
+
+from models import *
+from batch import normalize_text
+from metrics import span
+from store import sync_overlap_seconds
+
+# Standard deviations from a payee's usual amount before a charge is an outlier, and the history needed to judge it
+amount_outlier_z: float = float(os.environ.get("AMOUNT_OUTLIER_Z", 4))
+amount_outlier_min_history: int = int(os.environ.get("AMOUNT_OUTLIER_MIN_HISTORY", 5))
+
+# Transactions seen before an unfamiliar payee is worth flagging
+new_payee_warmup: int = int(os.environ.get("NEW_PAYEE_WARMUP", 20))
+
+# Size of the buckets velocity is counted in, how unusual a bucket must be, and the fewest transactions that can be a spike
+velocity_bucket_seconds: int = int(os.environ.get("VELOCITY_BUCKET_SECONDS", 24 * 60 * 60))
+velocity_spike_z: float = float(os.environ.get("VELOCITY_SPIKE_Z", 4))
+velocity_spike_min_count: int = int(os.environ.get("VELOCITY_SPIKE_MIN_COUNT", 5))
+
+# Anomalies are only found once, so the most recent ones are kept on the profile and reported with every scan
+recent_anomalies_limit: int = int(os.environ.get("RECENT_ANOMALIES_LIMIT", 50))
+
+# Empty buckets between two transactions count as zero, up to this many, so quiet periods keep the baseline low
+velocity_max_gap_buckets = 366
+
+def add_to_stats(stats: RunningStats, value: float):
+    stats.count += 1
+    delta = value - stats.mean
+    stats.mean += delta / stats.count
+    stats.m2 += delta * (value - stats.mean)
+
+def stats_std(stats: RunningStats) -> float:
+    return math.sqrt(stats.m2 / (stats.count - 1)) if stats.count > 1 else 0.0
+
+def is_outlier(stats: RunningStats, value: float, z: float) -> bool:
+    std = stats_std(stats)
+    return std > 0 and abs(value - stats.mean) > z * std
+
+def to_cents(amount: str) -> int:
+    return round(float(amount) * 100)
+
+# Transaction ids are only unique within an account, so the watermark keeps them qualified by account
+def watermark_id(transaction: Transaction) -> str:
+    return f"{transaction.account_id}/{transaction.id}"
+
+# Transactions the profile hasn't processed yet, oldest first
+# Transactions can post late, and accounts can sync behind one another, so rather than only taking what is newer than
+# last_posted, the ids processed within the sync overlap of it are remembered and anything else in that window is new
+def unseen_transactions(profile: BehaviorProfile, transactions: list[Transaction]) -> list[Transaction]:
+    seen_ids = { transaction_id for _, transaction_id in profile.recent }
+    window_start = profile.last_posted - sync_overlap_seconds
+    new_transactions = [t for t in transactions if t.posted >= window_start and watermark_id(t) not in seen_ids]
+    new_transactions.sort(key=lambda t: (t.posted, watermark_id(t)))
+    return new_transactions
+
+# Feeds transactions the profile hasn't seen into it, each in O(1), and returns any anomalies among them
+# Anomalies aren't reported while a profile is first built from the user's existing history
+def update_behavior_profile(profile: BehaviorProfile, transactions: list[Transaction]) -> list[PossibleFraudInstance]:
+    new_transactions = unseen_transactions(profile, transactions)
+    if not new_transactions:
+        return []
+
+    report_anomalies = profile.transaction_count > 0
+    payees = { payee_profile.payee: payee_profile for payee_profile in profile.payees }
+    anomalies: list[PossibleFraudInstance] = []
+    bucket_transactions: list[Transaction] = []
+
+    for transaction in new_transactions:
+        cents = to_cents(transaction.amount)
+        payee = normalize_text(transaction.payee)
+        payee_profile = payees.get(payee)
+
+        # A payee never seen before, or an amount far outside what this payee usually charges
+        if payee_profile is None:
+            if report_anomalies and profile.transaction_count >= new_payee_warmup:
+                anomalies.append(PossibleFraudInstance(transactions=[transaction], fraud_type="new_payee"))
+            payee_profile = payees[payee] = PayeeProfile(payee=payee, amounts=RunningStats())
+        elif report_anomalies and payee_profile.amounts.count >= amount_outlier_min_history and is_outlier(payee_profile.amounts, cents, amount_outlier_z):
+            anomalies.append(PossibleFraudInstance(transactions=[transaction], fraud_type="amount_outlier"))
+        add_to_stats(payee_profile.amounts, cents)
+        profile.transaction_count += 1
+
+        # Close out finished buckets, including any empty ones in between, before counting this transaction
+        # A late transaction belonging to an already closed bucket isn't counted, as that bucket's count is final
+        bucket = transaction.posted // velocity_bucket_seconds
+        if profile.velocity_bucket is not None and bucket < profile.velocity_bucket:
+            continue
+        if profile.velocity_bucket is None:
+            profile.velocity_bucket = bucket
+        elif bucket > profile.velocity_bucket:
+            add_to_stats(profile.velocity, profile.velocity_bucket_count)
+            for _ in range(min(bucket - profile.velocity_bucket - 1, velocity_max_gap_buckets)):
+                add_to_stats(profile.velocity, 0)
+            profile.velocity_bucket = bucket
+            profile.velocity_bucket_count = 0
+            profile.velocity_alerted = False
+            bucket_transactions = []
+        profile.velocity_bucket_count += 1
+        bucket_transactions.append(transaction)
+
+        # Unusually many transactions in the current bucket, flagged once per bucket
+        if (report_anomalies and not profile.velocity_alerted
+                and profile.velocity_bucket_count >= velocity_spike_min_count
+                and is_outlier(profile.velocity, profile.velocity_bucket_count, velocity_spike_z)
+                and profile.velocity_bucket_count > profile.velocity.mean):
+            anomalies.append(PossibleFraudInstance(transactions=list(bucket_transactions), fraud_type="velocity_spike"))
+            profile.velocity_alerted = True
+
+    # Move the watermark past everything processed, remembering what was processed within the overlap window
+    profile.last_posted = max(profile.last_posted, new_transactions[-1].posted)
+    window_start = profile.last_posted - sync_overlap_seconds
+    profile.recent = [
+        (posted, transaction_id)
+        for posted, transaction_id in profile.recent + [(t.posted, watermark_id(t)) for t in new_transactions]
+        if posted >= window_start
+    ]
+    profile.payees = list(payees.values())
+    profile.recent_anomalies = (anomalies + profile.recent_anomalies)[:recent_anomalies_limit]
+    return anomalies
+
+async def load_behavior_profile(database, username: str) -> BehaviorProfile:
+    with span("mongo", "load_behavior_profile"):
+        user_record = await database['users'].find_one({ "_id": username }, projection={ "behavior_profile": 1 })
+    stored_profile = (user_record or {}).get('behavior_profile')
+    return BehaviorProfile(**stored_profile) if stored_profile else BehaviorProfile()
+
+# Saves the profile unless another scan saved a newer one first, returning whether it was saved
+async def save_behavior_profile(database, username: str, profile: BehaviorProfile) -> bool:
+    query = { "_id": username }
+    if profile.version:
+        query["behavior_profile.version"] = profile.version
+    else:
+        query["behavior_profile"] = { "$exists": False }
+    profile.version += 1
+    with span("mongo", "save_behavior_profile"):
+        result = await database['users'].update_one(query, { "$set": { "behavior_profile": profile.model_dump() } })
+    return result.modified_count == 1
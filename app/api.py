@@ -4,18 +4,75 @@
 #   IMPORTS   #
 #-------------#
 
+import json
+import logging
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from fastapi.encoders import jsonable_encoder
+from brotli_asgi import BrotliMiddleware
+from fastapi import Depends, FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
-from argon2 import PasswordHasher
-from argon2.exceptions import VerificationError, VerifyMismatchError
+from fastapi.responses import StreamingResponse
+from pymongo import AsyncMongoClient
+
+# Loads environment variables from a .env file if present for local development
+# This happens before the local modules are imported, as they read their configuration on import
+load_dotenv()
+
+from logs import configure_logging
+configure_logging()
 
 from models import *
 from helpers import *
 from detection import *
+from auth import *
+from store import *
+from summaries import *
+from scheduler import *
+from users import *
+from metrics import *
+import clients
+import data_sources
+import processes
+
+logger = logging.getLogger("api")
+
+
+#---------------------#
+#   INITIALIZE APIS   #
+#---------------------#
+
+# Runs once in every server worker: connects to mongodb and opens shared clients before the worker serves requests,
+# and closes them once it has stopped
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.mongodb_client = AsyncMongoClient(os.environ.get("ATLAS_URI"))
+    app.database = app.mongodb_client[os.environ.get("DB_NAME")]
+    logger.info("Connected to the MongoDB database")
+    app.users = UserRepository(app.database['users'])
+    register_cache("users", app.users.cache)
+    logger.info("User table initialized")
+    await create_store_indexes(app.database)
+    logger.info("Transaction store initialized")
+    await create_summary_indexes(app.database)
+    clients.open_clients()
+    data_sources.open_data_sources()
+    processes.open_process_pool(preload=("detection",))
+
+    # Scan users for fraud in the background, in whichever worker holds the scheduler lease
+    app.fraud_scan_scheduler = FraudScanScheduler(app.database)
+    if os.environ.get("FRAUD_SCAN_SCHEDULER", "true").lower() in ("1", "true", "yes"):
+        app.fraud_scan_scheduler.start()
+        logger.info("Fraud scan scheduler started")
+
+    yield
+
+    await app.fraud_scan_scheduler.stop()
+    await app.mongodb_client.close()
+    await clients.close_clients()
+    hash_executor.shutdown()
+    processes.close_process_pool()
+    close_metrics()
 
 
 #------------------------#
@@ -23,7 +80,7 @@ from detection import *
 #------------------------#
 
 # Creates FastAPI App
-app = FastAPI() 
+app = FastAPI(lifespan=lifespan)
 origins = ["*"]
 
 # Allows cross-origin requests
@@ -33,32 +90,33 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Scanned-At", "X-Failed-Detectors", "Server-Timing"],
 )                                                   
 
+# Compresses larger responses with brotli, or gzip for clients that don't accept brotli
+# Summaries are left alone so streamed tokens aren't held back by the compressor
+app.add_middleware(BrotliMiddleware, minimum_size=1000, gzip_fallback=True, excluded_handlers=["^/llm_fraud_summary"])
 
-#---------------------#
-#   INITIALIZE APIS   #
-#---------------------#
+# Times every request as the outermost middleware, so compression and streamed bodies are included
+app.add_middleware(MetricsMiddleware)
 
-# Loads environment variables from a .env file if present for local development
-load_dotenv()
 
-# Initialize password hasher
-hasher: PasswordHasher = PasswordHasher()
+#--------------------#
+#   AUTHENTICATION   #
+#--------------------#
 
-# Connect to mongodb on startup
-@app.on_event("startup")
-def startup_db_client():
-    app.mongodb_client = MongoClient(os.environ.get("ATLAS_URI"))
-    app.database = app.mongodb_client[os.environ.get("DB_NAME")]
-    print("Connected to the MongoDB database!")
-    app.users = app.database['users']
-    print("User table initialized!")
+# Resolve the session token on a request to the user's database record
+async def get_authenticated_user(username: str = Depends(authenticated_username)) -> dict:
+    user_record = await app.users.get(username)
+    if not user_record:
+        raise HTTPException(status_code=404, detail="User does not exist")
+    return user_record
 
-# Close mongodb connection on shutdown
-@app.on_event("shutdown")
-def shutdown_db_client():
-    app.mongodb_client.close()
+# Same as above, but for endpoints that need the user to have linked SimpleFIN
+async def get_simplefin_user(user_record: dict = Depends(get_authenticated_user)) -> dict:
+    if not user_record['simplefin_access_url']:
+        raise HTTPException(status_code=403, detail="User does not have a SimpleFIN access URL")
+    return user_record
 
 
 #---------------#
@@ -72,42 +130,43 @@ async def sanity_check():
         "message": "Welcome to the Pufferfish API! To read more about the available endpoints, visit https://pufferfish-xurta.ondigitalocean.app/docs"
     }
 
+# Prometheus metrics: request and stage latency histograms, error counts and cache statistics
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return metrics_response()
+
 # Check for valid credentials
 @app.post("/credential_check")
 async def credential_check(user_auth_details: UserAuthDetails):
     # Check if user exists
-    if not app.users.count_documents({ "_id": user_auth_details.username }):
+    user_record = await app.users.get(user_auth_details.username)
+    if not user_record:
         raise HTTPException(status_code=404, detail="User does not exist")
-    user_record = app.users.find_one({ "_id": user_auth_details.username })
     
     # Check if given hashed password matches user's
-    db_password_hash = user_record['password_hash']
-    try:
-        if not verify_password(hasher, user_auth_details.password, db_password_hash):
-            raise HTTPException(status_code=403, detail="Incorrect password provided")
-    except (VerifyMismatchError, VerificationError) as _v:
-        raise HTTPException(status_code=403, detail="Incorrect password provided")
+    await check_password(user_auth_details.password, user_record['password_hash'])
     
     return {
         "message": f"Authenticated {user_record['friendly_name']} successfully!"
     }
 
-# Get user's friendly name
-@app.post("/get_friendly_name")
-async def get_friendly_name(user_auth_details: UserAuthDetails):
+# Exchange credentials for a session token used by every other endpoint
+@app.post("/login")
+async def login(user_auth_details: UserAuthDetails) -> SessionToken:
     # Check if user exists
-    if not app.users.count_documents({ "_id": user_auth_details.username }):
+    user_record = await app.users.get(user_auth_details.username)
+    if not user_record:
         raise HTTPException(status_code=404, detail="User does not exist")
-    user_record = app.users.find_one({ "_id": user_auth_details.username })
     
     # Check if given hashed password matches user's
-    db_password_hash = user_record['password_hash']
-    try:
-        if not verify_password(hasher, user_auth_details.password, db_password_hash):
-            raise HTTPException(status_code=403, detail="Incorrect password provided")
-    except (VerifyMismatchError, VerificationError) as _v:
-        raise HTTPException(status_code=403, detail="Incorrect password provided")
-    
+    await check_password(user_auth_details.password, user_record['password_hash'])
+    logger.info("User logged in", extra={ "username": user_auth_details.username })
+
+    return issue_session_token(user_auth_details.username)
+
+# Get user's friendly name
+@app.post("/get_friendly_name")
+async def get_friendly_name(user_record: dict = Depends(get_authenticated_user)):
     return user_record['friendly_name']
 
 # Create a new user
@@ -119,169 +178,112 @@ async def create_user(user_create_request: UserCreateRequest):
     friendly_name: str = user_create_request.friendly_name
 
     # Check if user is in db
-    if app.users.count_documents({ "_id": username }):
+    if await app.users.get(username):
         raise HTTPException(status_code=409, detail="Username is already taken")
 
     # Hash password and create user model
-    hashed_password: str = hash_password(hasher, password)
+    hashed_password: str = await hash_password_async(password)
     user = DBUser(_id=username, password_hash=hashed_password, friendly_name=friendly_name, simplefin_access_url=None)
 
     # Create new MongoDB document for user
-    encoded_user = jsonable_encoder(user)
-    print(encoded_user)
-    db_response = app.users.insert_one(encoded_user)
-    print(db_response)
-    created_user = app.users.find_one(
-        {"_id": username}
-    )
-    print(created_user)
+    created_user = await app.users.create(user)
 
     return db_response_to_user_info(created_user)
 
 # Go through SimpleFIN Bridge setup token flow for user
 @app.post("/setup_simplefin")
-async def setup_simplefin(user_simplefin_setup: UserSimpleFINSetup):
-    # Check if user exists
-    user_auth_details = user_simplefin_setup.auth_details
-    if not app.users.count_documents({ "_id": user_auth_details.username }):
-        raise HTTPException(status_code=404, detail="User does not exist")
-    user_record = app.users.find_one({ "_id": user_auth_details.username })
-    
-    # Check if given hashed password matches user's
-    db_password_hash = user_record['password_hash']
-    try:
-        if not verify_password(hasher, user_auth_details.password, db_password_hash):
-            raise HTTPException(status_code=403, detail="Incorrect password provided")
-    except (VerifyMismatchError, VerificationError) as _v:
-        raise HTTPException(status_code=403, detail="Incorrect password provided")
-    print(f"User {user_auth_details.username} authenticated successfully!")
-
+async def setup_simplefin(user_simplefin_setup: UserSimpleFINSetup, user_record: dict = Depends(get_authenticated_user)):
     # Exchange setup token for access token
-    simplefin_access_url = exchange_simplefin_setup(user_simplefin_setup.simplefin_setup_token)
+    simplefin_access_url = await exchange_simplefin_setup(user_simplefin_setup.simplefin_setup_token)
 
-    # Add access url to database
-    app.users.update_one({ "_id": user_auth_details.username }, { "$set": { "simplefin_access_url": simplefin_access_url } })
+    # Add access url to database, and drop anything synced from a previously linked account
+    await app.users.set_simplefin_access_url(user_record['_id'], simplefin_access_url)
+    await clear_synced_data(app.database, user_record['_id'])
 
     return {
-        "message": f"Added SimpleFIN access URL for {user_auth_details.username} successfully!"
+        "message": f"Added SimpleFIN access URL for {user_record['_id']} successfully!"
     }
 
 # Get frontpage data
-@app.post("/frontpage_data")
-async def frontpage_data(user_auth_details: UserAuthDetails):
-    # Check if user exists
-    if not app.users.count_documents({ "_id": user_auth_details.username }):
-        raise HTTPException(status_code=404, detail="User does not exist")
-    user_record = app.users.find_one({ "_id": user_auth_details.username })
-    
-    # Check if given hashed password matches user's
-    db_password_hash = user_record['password_hash']
-    try:
-        if not verify_password(hasher, user_auth_details.password, db_password_hash):
-            raise HTTPException(status_code=403, detail="Incorrect password provided")
-    except (VerifyMismatchError, VerificationError) as _v:
-        raise HTTPException(status_code=403, detail="Incorrect password provided")
-    
-    print(f"Authenticated {user_record['friendly_name']} successfully!")
-    
-    # Check if user has a SimpleFIN access url
-    if not user_record['simplefin_access_url']:
-        raise HTTPException(status_code=403, detail="User does not have a SimpleFIN access URL")
-    
-    frontpage_data = get_frontpage_data(user_record['simplefin_access_url'])
-    return frontpage_data
-
-# Get all transactions
-@app.post("/transactions")
-async def get_transactions(user_auth_details: UserAuthDetails):
-    # Check if user exists
-    if not app.users.count_documents({ "_id": user_auth_details.username }):
-        raise HTTPException(status_code=404, detail="User does not exist")
-    user_record = app.users.find_one({ "_id": user_auth_details.username })
-    
-    # Check if given hashed password matches user's
-    db_password_hash = user_record['password_hash']
-    try:
-        if not verify_password(hasher, user_auth_details.password, db_password_hash):
-            raise HTTPException(status_code=403, detail="Incorrect password provided")
-    except (VerifyMismatchError, VerificationError) as _v:
-        raise HTTPException(status_code=403, detail="Incorrect password provided")
-    
-    print(f"Authenticated {user_record['friendly_name']} successfully!")
-    
-    # Check if user has a SimpleFIN access url
-    if not user_record['simplefin_access_url']:
-        raise HTTPException(status_code=403, detail="User does not have a SimpleFIN access URL")
-    
-    simplefin_data = get_simplefin_data(user_record['simplefin_access_url'])
-    transaction_dicts = simplefin_data["accounts"][0]["transactions"]
-    transactions = import_transactions_from_dict(transaction_dicts)
-    return transactions
+@app.post("/frontpage_data", response_model=FrontpageData)
+async def frontpage_data(user_record: dict = Depends(get_simplefin_user)):
+    # Balances come from the stored accounts, and only the most recent transactions across them are shown
+    accounts = await get_synced_accounts(app.database, user_record)
+    transactions = await load_transactions(app.database, user_record['_id'], limit=3)
+    frontpage_data = get_frontpage_data(accounts, transactions)
+    return json_response(frontpage_data)
+
+# Get transactions across all accounts, or only those of account_id, newest first
+# Pages are requested with limit, and the X-Next-Cursor response header is passed back as cursor to get the next one
+# start and end restrict results to transactions posted in [start, end), and stream=true sends NDJSON as rows are read
+@app.post("/transactions", response_model=list[Transaction])
+async def get_transactions(
+    user_record: dict = Depends(get_simplefin_user),
+    account_id: str | None = None,
+    limit: int | None = Query(default=None, ge=1, le=1000),
+    cursor: str | None = None,
+    start: int | None = None,
+    end: int | None = None,
+    stream: bool = False
+):
+    await get_synced_accounts(app.database, user_record)
+    filters = { "start": start, "end": end, "after": decode_cursor(cursor) if cursor else None, "limit": limit }
+
+    if stream:
+        transaction_cursor = find_transactions(app.database, user_record['_id'], account_id, **filters)
+        return StreamingResponse(stream_ndjson(transaction_cursor), media_type="application/x-ndjson")
+
+    transactions = await load_transactions(app.database, user_record['_id'], account_id, **filters)
+    headers = None
+    if limit is not None and len(transactions) == limit:
+        headers = { "X-Next-Cursor": encode_cursor(transactions[-1]) }
+    return json_response(transactions, headers=headers)
   
-# Scan for possibly fraudulent transactions
-@app.post("/detect_fraud")
-async def detect_fraud(user_auth_details: UserAuthDetails):
-    # Check if user exists
-    if not app.users.count_documents({ "_id": user_auth_details.username }):
-        raise HTTPException(status_code=404, detail="User does not exist")
-    user_record = app.users.find_one({ "_id": user_auth_details.username })
-    
-    # Check if given hashed password matches user's
-    db_password_hash = user_record['password_hash']
-    try:
-        if not verify_password(hasher, user_auth_details.password, db_password_hash):
-            raise HTTPException(status_code=403, detail="Incorrect password provided")
-    except (VerifyMismatchError, VerificationError) as _v:
-        raise HTTPException(status_code=403, detail="Incorrect password provided")
-    
-    print(f"Authenticated {user_record['friendly_name']} successfully!")
-    
-    # Check if user has a SimpleFIN access url
-    if not user_record['simplefin_access_url']:
-        raise HTTPException(status_code=403, detail="User does not have a SimpleFIN access URL")
-    
-    simplefin_data = get_simplefin_data(user_record['simplefin_access_url'])
-    transaction_dicts = simplefin_data["accounts"][0]["transactions"]
-    transactions = import_transactions_from_dict(transaction_dicts)
-    possible_fraud_instances = detect_all(transactions)
-    return possible_fraud_instances
-
-# Provide an AI summary of a possibly fraudulent transaction
-@app.post("/llm_fraud_summary")
-async def llm_fraud_summary(summarize_request: PossibleFraudSummarizeRequest):
-    # Check if user exists
-    if not app.users.count_documents({ "_id": summarize_request.auth_details.username }):
-        raise HTTPException(status_code=404, detail="User does not exist")
-    user_record = app.users.find_one({ "_id": summarize_request.auth_details.username })
-    
-    # Check if given hashed password matches user's
-    db_password_hash = user_record['password_hash']
-    try:
-        if not verify_password(hasher, summarize_request.auth_details.password, db_password_hash):
-            raise HTTPException(status_code=403, detail="Incorrect password provided")
-    except (VerifyMismatchError, VerificationError) as _v:
-        raise HTTPException(status_code=403, detail="Incorrect password provided")
-    
-    print(f"Authenticated {user_record['friendly_name']} successfully!")
-    
-    # Check if user has a SimpleFIN access url
-    if not user_record['simplefin_access_url']:
-        raise HTTPException(status_code=403, detail="User does not have a SimpleFIN access URL")
-
-    system_prompt = "You are a helpful AI fraud detection assistant, helping summarize possible instances of fraud in the user's bank transaction history"
-    user_prompt = f'''Based on the SimpleFIN transaction data in JSON format that is below the line \"DATA BEGINS HERE\", summarize in a short paragraph for an inexperienced user what factors make the transaction(s) appear to be fraudulent, and what the user can do to remedy the situation.
-
-    DATA BEGINS HERE
-    {jsonable_encoder(summarize_request.possible_fraud_instance)}'''
-
-    client = OpenAI(
-        api_key=os.environ.get("LLM_API_KEY"),
-        base_url=os.environ.get("LLM_BASE_URL")
+# Get possibly fraudulent transactions from the user's latest background scan
+# With refresh=true, or if there is no recent scan, a new scan is run and stored first, with refresh also syncing fresh data
+@app.post("/detect_fraud", response_model=list[PossibleFraudInstance])
+async def detect_fraud(user_record: dict = Depends(get_simplefin_user), refresh: bool = False):
+    fraud_scan = None if refresh else await load_latest_scan(app.database, user_record['_id'])
+    headers = {}
+    if fraud_scan is None:
+        fraud_scan = await scan_user(app.database, user_record, force_sync=refresh)
+        headers["Server-Timing"] = server_timing_header(fraud_scan)
+    headers.update(fraud_scan_headers(fraud_scan))
+    return json_response(fraud_scan.possible_fraud_instances, headers=headers)
+
+# Get frontpage data, transactions and fraud scan results together from a single load of the user's data
+# Fraud results come from the latest stored scan, the same as /detect_fraud, and only scanned here if there isn't one
+@app.post("/dashboard", response_model=DashboardData)
+async def dashboard(user_record: dict = Depends(get_simplefin_user)):
+    accounts, transactions = await load_synced_data(app.database, user_record)
+    fraud_scan = await load_latest_scan(app.database, user_record['_id'])
+    headers = {}
+    if fraud_scan is None:
+        fraud_scan = await scan_user(app.database, user_record, transactions)
+        headers["Server-Timing"] = server_timing_header(fraud_scan)
+    headers.update(fraud_scan_headers(fraud_scan))
+    dashboard_data = DashboardData(
+        frontpage_data = get_frontpage_data(accounts, transactions),
+        transactions = transactions,
+        possible_fraud_instances = fraud_scan.possible_fraud_instances
     )
+    return json_response(dashboard_data, headers=headers)
 
-    responses = client.chat.completions.create(
-        model='Meta-Llama-3.1-405B-Instruct',
-        messages=[{"role": "system", "content": system_prompt}, {"role":"user", "content":user_prompt}]
+# Provide an AI summary of a possibly fraudulent transaction
+# With stream=true the summary is sent as server-sent events as it is generated, ending with a "done" event
+@app.post("/llm_fraud_summary", response_model=str)
+async def llm_fraud_summary(summarize_request: PossibleFraudSummarizeRequest, user_record: dict = Depends(get_simplefin_user), stream: bool = False):
+    possible_fraud_instance = summarize_request.possible_fraud_instance
+    if not stream:
+        return await summarize_fraud_instance(app.database, possible_fraud_instance)
+
+    async def summary_events():
+        async for piece in stream_fraud_instance_summary(app.database, possible_fraud_instance):
+            yield f"data: {json.dumps(piece)}\n\n"
+        yield "event: done\ndata: \n\n"
+
+    return StreamingResponse(
+        summary_events(),
+        media_type="text/event-stream",
+        headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" }
     )
-    response = responses.choices[0].message.content
-    return response
\ No newline at end of file
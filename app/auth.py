@@ -0,0 +1,89 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, VerifyMismatchError
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+from models import *
+from helpers import *
+from metrics import span
+from processes import web_concurrency
+
+# Initialize password hasher
+hasher: PasswordHasher = PasswordHasher()
+
+# Argon2 is slow on purpose, so it runs on a small bounded pool instead of the event loop
+hash_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", 2)),
+    thread_name_prefix="argon2"
+)
+
+# Session tokens are signed with a shared secret, falling back to a per-process one for local development
+# With several workers each would make up its own, and a token would only be accepted by the worker that issued it
+if not os.environ.get("SESSION_SECRET") and web_concurrency > 1:
+    raise RuntimeError("SESSION_SECRET must be set when running more than one worker")
+session_secret: bytes = os.environ.get("SESSION_SECRET", "").encode() or secrets.token_bytes(32)
+session_ttl_seconds: int = int(os.environ.get("SESSION_TTL_SECONDS", 3600))
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+async def hash_password_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    with span("auth", "hash_password"):
+        return await loop.run_in_executor(hash_executor, hash_password, hasher, password)
+
+async def check_password(given_password: str, password_hash: str) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+        with span("auth", "check_password"):
+            verified = await loop.run_in_executor(hash_executor, verify_password, hasher, given_password, password_hash)
+        if not verified:
+            raise HTTPException(status_code=403, detail="Incorrect password provided")
+    except (VerifyMismatchError, VerificationError) as _v:
+        raise HTTPException(status_code=403, detail="Incorrect password provided")
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(session_secret, payload.encode(), hashlib.sha256).digest())
+
+def issue_session_token(username: str) -> SessionToken:
+    expires_at = int(time.time()) + session_ttl_seconds
+    claims = json.dumps({"sub": username, "exp": expires_at}, separators=(",", ":"))
+    payload = _b64encode(claims.encode())
+    return SessionToken(access_token=f"{payload}.{_sign(payload)}", expires_at=expires_at)
+
+def verify_session_token(token: str) -> str:
+    invalid_token = HTTPException(status_code=401, detail="Invalid session token", headers={"WWW-Authenticate": "Bearer"})
+
+    # Check the signature before trusting anything inside the payload
+    payload, _, signature = token.partition(".")
+    if not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+        raise invalid_token
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError as _e:
+        raise invalid_token
+
+    if claims["exp"] < time.time():
+        raise HTTPException(status_code=401, detail="Session token has expired", headers={"WWW-Authenticate": "Bearer"})
+    return claims["sub"]
+
+# FastAPI dependency resolving the bearer token on a request to a username
+async def authenticated_username(credentials: HTTPAuthorizationCredentials | None = Depends(bearer_scheme)) -> str:
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Missing session token", headers={"WWW-Authenticate": "Bearer"})
+    with span("auth", "verify_token"):
+        return verify_session_token(credentials.credentials)
@@ -0,0 +1,103 @@
+import copy
+import re
+import numpy as np
+
+from models import *
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+text_columns = ("payee", "memo", "description", "text")
+pickle_separator = "\x1f"
+
+# Column-oriented view of a list of transactions, built once per scan so detectors can work on whole arrays at a time
+class TransactionBatch:
+    def __init__(self, transactions: list[Transaction]):
+        self.transactions = transactions
+        self.size = len(transactions)
+
+        # Amounts as integer cents rather than strings, and posted times as unix timestamps
+        self.cents: np.ndarray = np.rint(np.array([t.amount for t in transactions], dtype=np.float64) * 100).astype(np.int64)
+        self.posted: np.ndarray = np.fromiter((t.posted for t in transactions), dtype=np.int64, count=self.size)
+
+        # Lower-cased, whitespace-collapsed text fields, plus all three joined for single-pass keyword matching
+        self.payee: list[str] = [normalize_text(t.payee) for t in transactions]
+        self.memo: list[str] = [normalize_text(t.memo) for t in transactions]
+        self.description: list[str] = [normalize_text(t.description) for t in transactions]
+        self.text: list[str] = [f"{payee}\n{memo}\n{description}" for payee, memo, description in zip(self.payee, self.memo, self.description)]
+
+        self.account_rows = self.group_by_account()
+
+    def select(self, indices: np.ndarray) -> list[Transaction]:
+        if self.transactions is None:
+            return [Transaction.model_construct(id=str(index)) for index in indices]
+        return [self.transactions[index] for index in indices]
+
+    # A copy of the batch without its transactions, which are by far the costliest part to send to another process
+    # Transactions selected from it are placeholders holding only their row, which attach swaps back for the real ones
+    def detach(self) -> "TransactionBatch":
+        batch = copy.copy(self)
+        batch.transactions = None
+        return batch
+
+    def attach(self, possible_fraud_instances: list[PossibleFraudInstance]) -> list[PossibleFraudInstance]:
+        for possible_fraud_instance in possible_fraud_instances:
+            possible_fraud_instance.transactions = [self.transactions[int(t.id)] for t in possible_fraud_instance.transactions]
+        return possible_fraud_instances
+
+    # Text columns are pickled as one string each, which is many times faster than a list of short strings
+    # Normalized text can't contain the separator, as str.split() treats it as whitespace
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__)
+        for column in text_columns:
+            state[column] = pickle_separator.join(state[column])
+        return state
+
+    def __setstate__(self, state: dict):
+        for column in text_columns:
+            state[column] = state[column].split(pickle_separator) if state["size"] else []
+        self.__dict__.update(state)
+
+    # A batch of only the given rows, sharing the columns already built rather than normalizing the text again
+    def subset(self, indices: np.ndarray) -> "TransactionBatch":
+        batch = TransactionBatch([])
+        batch.transactions = self.select(indices)
+        batch.size = len(indices)
+        batch.cents = self.cents[indices]
+        batch.posted = self.posted[indices]
+        for column in text_columns:
+            values = getattr(self, column)
+            setattr(batch, column, [values[index] for index in indices])
+        batch.account_rows = batch.group_by_account()
+        return batch
+
+    # Rows of each account, in order of first appearance
+    def group_by_account(self) -> dict[str | None, np.ndarray]:
+        account_codes: dict[str | None, int] = {}
+        codes = np.fromiter(
+            (account_codes.setdefault(t.account_id, len(account_codes)) for t in self.transactions),
+            dtype=np.int64, count=self.size
+        )
+        return { account_id: np.flatnonzero(codes == code) for account_id, code in account_codes.items() }
+
+    # One batch per account
+    def split_by_account(self) -> list["TransactionBatch"]:
+        if len(self.account_rows) == 1:
+            return [self]
+        return [self.subset(rows) for rows in self.account_rows.values()]
+
+# Matches any of a set of keywords with one compiled pattern instead of one substring test per keyword
+class KeywordMatcher:
+    def __init__(self, keywords: list[str]):
+        alternatives = sorted((re.escape(normalize_text(keyword)) for keyword in keywords), key=len, reverse=True)
+        self.pattern = re.compile("|".join(alternatives))
+
+    # Boolean mask of which of the batch's rows (optionally only the candidate rows) mention a keyword
+    def mask(self, batch: TransactionBatch, candidates: np.ndarray | None = None) -> np.ndarray:
+        result = np.zeros(batch.size, dtype=bool)
+        rows = candidates if candidates is not None else range(batch.size)
+        search = self.pattern.search
+        for row in rows:
+            if search(batch.text[row]) is not None:
+                result[row] = True
+        return result
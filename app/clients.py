@@ -0,0 +1,32 @@
+import os
+import httpx
+from openai import AsyncOpenAI
+
+# Shared network clients, opened once on startup so every request reuses the same connection pools
+# Access these as clients.http_client / clients.llm_client, since they are only set once the app starts
+http_client: httpx.AsyncClient | None = None
+llm_client: AsyncOpenAI | None = None
+
+def open_clients():
+    global http_client, llm_client
+
+    # Pooled keep-alive client for SimpleFIN Bridge
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(float(os.environ.get("SIMPLEFIN_TIMEOUT", 30)), connect=5.0),
+        limits=httpx.Limits(
+            max_connections=int(os.environ.get("SIMPLEFIN_MAX_CONNECTIONS", 50)),
+            max_keepalive_connections=int(os.environ.get("SIMPLEFIN_MAX_KEEPALIVE", 10)),
+            keepalive_expiry=30.0
+        )
+    )
+
+    # Single OpenAI compatible client for the LLM endpoint
+    llm_client = AsyncOpenAI(
+        api_key=os.environ.get("LLM_API_KEY"),
+        base_url=os.environ.get("LLM_BASE_URL"),
+        timeout=float(os.environ.get("LLM_TIMEOUT", 120))
+    )
+
+async def close_clients():
+    await http_client.aclose()
+    await llm_client.close()
@@ -1,91 +1,252 @@
-from fastapi.encoders import jsonable_encoder
-from openai import OpenAI
-import os
+from typing import Callable, NamedTuple
+import asyncio
 import json
+import logging
+import os
+import time
+
+import numpy as np
 
 from models import *
+from batch import *
+from cache import LRUCache
+from metrics import record_stage, register_cache, span
+from processes import run_in_process, run_off_loop
+import clients
 
-def detect_duplicates(transactions: list[Transaction]) -> list[PossibleFraudInstance]:
-    transaction_amounts = {transaction.amount for transaction in transactions}
-    transactions_by_amount = {amount: [transaction for transaction in transactions if transaction.amount == amount] for amount in transaction_amounts}
-    transactions_by_amount_filtered = [transaction_list for transaction_list in transactions_by_amount.values() if len(transaction_list) > 1]
-    possible_fraud_instances: list[PossibleFraudInstance] = []
+logger = logging.getLogger("detection")
 
-    for transaction_list in transactions_by_amount_filtered:
-        while transaction_list:
-            target_record = transaction_list.pop()
-            for record in transaction_list:
-                if record.memo == target_record.memo and record.payee == target_record.payee and record.description == target_record.description:
-                    possible_fraud_instance = PossibleFraudInstance(
-                        transactions = [target_record, record],
-                        fraud_type = "duplicate"
-                    )
-                    possible_fraud_instances.append(possible_fraud_instance)
-                    transaction_list.remove(record)
-    return possible_fraud_instances
+#-----------------------#
+#   DETECTOR REGISTRY   #
+#-----------------------#
 
-def detect_suspicious_payee(transactions: list[Transaction]) -> list[PossibleFraudInstance]:
-    system_prompt = "You are a helpful AI data analyst, responsible for analyzing transaction records to find suspicious activity"
-    user_prompt = f'''Based on the transaction data in JSON format that is below the line \"DATA BEGINS HERE\", determine whether any of these transactions appear to be suspicious. A transaction is suspicious if the transaction's memo, payee, or description fields appear to be vague, incoherent, are in a language other than English, or reference companies that could be based out of nations that are known to conduct financial fraud, such as China, Russia, or North Korea. Respond only with the transaction records of the suspicious transactions in JSON format. Do not explain why the transactions are suspicious, or provide any text output other than the transaction records. Do not wrap output in a markdown code block.
-    The output of the data should be formatted as JSON serialized data following the below PossibleFraudInstance pydantic schema:
+class Detector(NamedTuple):
+    name: str
+    func: Callable # takes a TransactionBatch of transactions, returns possible fraud instances, may be async
+    timeout: float | None # seconds before the detector is given up on for this scan
+    scope: str # "user" to see every account's transactions together, "account" to run on each account separately
 
-    class PossibleFraudInstance(BaseModel):
-        transactions: list[Transaction]
-        fraud_type: str # duplicate, suspicious_payee, large_p2p
+detector_registry: dict[str, Detector] = {}
 
-    class Transaction(BaseModel):
-        id: str
-        posted: int
-        amount: str
-        description: str
-        payee: str
-        memo: str
+# Registers a detector so every scan runs it
+def register_detector(name: str, timeout: float | None = None, scope: str = "account"):
+    def decorator(func: Callable) -> Callable:
+        detector_registry[name] = Detector(name=name, func=func, timeout=timeout, scope=scope)
+        return func
+    return decorator
 
-    DATA BEGINS HERE
-    {jsonable_encoder(transactions)}'''
 
-    client = OpenAI(
-        api_key=os.environ.get("LLM_API_KEY"),
-        base_url=os.environ.get("LLM_BASE_URL")
-    )
+#---------------#
+#   DETECTORS   #
+#---------------#
+
+# Identical charges further apart than this are treated as recurring rather than duplicates, 0 disables the window
+duplicate_window_seconds: int = int(os.environ.get("DUPLICATE_WINDOW_SECONDS", 2 * 24 * 60 * 60))
+
+# Runs across accounts, so the same charge posted to two of the user's accounts is caught too
+@register_detector("duplicate", scope="user")
+def detect_duplicates(batch: TransactionBatch, window_seconds: int = duplicate_window_seconds) -> list[PossibleFraudInstance]:
+    if batch.size < 2:
+        return []
 
-    responses = client.chat.completions.create(
-        model='Meta-Llama-3.1-405B-Instruct',
-        messages=[{"role": "system", "content": system_prompt}, {"role":"user", "content":user_prompt}]
+    # Give each distinct (amount, payee, memo, description) combination an integer code in a single pass
+    key_codes: dict[tuple, int] = {}
+    codes = np.fromiter(
+        (key_codes.setdefault(key, len(key_codes)) for key in zip(batch.cents.tolist(), batch.payee, batch.memo, batch.description)),
+        dtype=np.int64, count=batch.size
     )
 
-    received_transactions = json.loads(responses.choices[0].message.content)
-    print(received_transactions)
-    possible_fraud_instances = [PossibleFraudInstance(transactions=[transaction], fraud_type = "suspicious_payee") for transaction in received_transactions['transactions']]
+    # Sort by code then posted time, and start a new cluster wherever the code changes
+    order = np.lexsort((batch.posted, codes))
+    sorted_codes = codes[order]
+    sorted_posted = batch.posted[order]
+    cluster_starts = np.ones(batch.size, dtype=bool)
+    cluster_starts[1:] = sorted_codes[1:] != sorted_codes[:-1]
+
+    # A cluster only reaches the window past its first charge, so a run of identical charges spanning longer, like a daily
+    # purchase, is split into clusters that each start at the first charge beyond the window of the one before
+    if window_seconds:
+        run_starts = np.flatnonzero(cluster_starts)
+        run_ends = np.append(run_starts[1:], batch.size)
+        long_runs = sorted_posted[run_ends - 1] - sorted_posted[run_starts] > window_seconds
+        for run_start, run_end in zip(run_starts[long_runs].tolist(), run_ends[long_runs].tolist()):
+            run_posted = sorted_posted[run_start:run_end]
+            start = int(np.searchsorted(run_posted, run_posted[0] + window_seconds, side="right"))
+            while start < len(run_posted):
+                cluster_starts[run_start + start] = True
+                start = int(np.searchsorted(run_posted, run_posted[start] + window_seconds, side="right"))
+
+    # Every cluster of more than one identical charge is a single instance
+    start_positions = np.flatnonzero(cluster_starts)
+    cluster_sizes = np.diff(np.append(start_positions, batch.size))
+    possible_fraud_instances: list[PossibleFraudInstance] = [
+        PossibleFraudInstance(transactions = batch.select(order[start:start + size]), fraud_type = "duplicate")
+        for start, size in zip(start_positions[cluster_sizes > 1].tolist(), cluster_sizes[cluster_sizes > 1].tolist())
+    ]
     return possible_fraud_instances
 
-def detect_large_p2p(transactions: list[Transaction]) -> list[PossibleFraudInstance]:
-    threshold = 100
-    p2p_services = ['venmo', 'zelle', 'cash app', 'paypal', 'apple cash']
-    possible_fraud_instances: list[PossibleFraudInstance] = []
-    for transaction in transactions:
-        converted_transaction_amount = float(transaction.amount.replace("-", ""))
-        amount_above_threshold = converted_transaction_amount >= threshold
-        p2p_in_payee = any(p2p_service in transaction.payee.lower() for p2p_service in p2p_services)
-        p2p_in_memo = any(p2p_service in transaction.memo.lower() for p2p_service in p2p_services)
-        p2p_in_description = any(p2p_service in transaction.description.lower() for p2p_service in p2p_services)
-        
-        if amount_above_threshold and (p2p_in_payee or p2p_in_memo or p2p_in_description):
-            possible_fraud_instance = PossibleFraudInstance(
-                transactions = [transaction],
-                fraud_type = "large_p2p"
+# Verdicts on (payee, memo, description) signatures the LLM has already classified, shared across users
+payee_verdict_cache = LRUCache(
+    maxsize=int(os.environ.get("PAYEE_VERDICT_CACHE_SIZE", 50000)),
+    ttl=float(os.environ.get("PAYEE_VERDICT_CACHE_TTL", 7 * 24 * 60 * 60))
+)
+register_cache("payee_verdicts", payee_verdict_cache)
+
+# Rough size of the signatures sent in one LLM request, and how many requests may be in flight per scan
+llm_batch_token_budget: int = int(os.environ.get("LLM_BATCH_TOKEN_BUDGET", 2000))
+llm_max_concurrency: int = int(os.environ.get("LLM_MAX_CONCURRENCY", 4))
+
+# Splits signatures into chunks that each fit the token budget, estimating ~4 characters per token
+def chunk_by_token_budget(signatures: list[tuple[str, str, str]], token_budget: int) -> list[list[tuple[str, str, str]]]:
+    chunks: list[list[tuple[str, str, str]]] = []
+    current_chunk: list[tuple[str, str, str]] = []
+    current_tokens = 0
+    for signature in signatures:
+        signature_tokens = len(json.dumps(signature)) // 4 + 8
+        if current_chunk and current_tokens + signature_tokens > token_budget:
+            chunks.append(current_chunk)
+            current_chunk = []
+            current_tokens = 0
+        current_chunk.append(signature)
+        current_tokens += signature_tokens
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+# Asks the LLM which signatures in a chunk look suspicious, and caches a verdict for each of them
+async def classify_signatures(signatures: list[tuple[str, str, str]], semaphore: asyncio.Semaphore) -> dict[tuple[str, str, str], bool]:
+    system_prompt = "You are a helpful AI data analyst, responsible for analyzing transaction records to find suspicious activity"
+    user_prompt = f'''Based on the transaction data in JSON format that is below the line \"DATA BEGINS HERE\", determine whether any of these transactions appear to be suspicious. A transaction is suspicious if the transaction's memo, payee, or description fields appear to be vague, incoherent, are in a language other than English, or reference companies that could be based out of nations that are known to conduct financial fraud, such as China, Russia, or North Korea. Respond only with the index of each suspicious transaction in JSON format. Do not explain why the transactions are suspicious, or provide any text output other than the JSON. Do not wrap output in a markdown code block.
+    The output of the data should be formatted as a JSON object in the following format, where the list is empty if no transactions are suspicious:
+
+    {{"suspicious": [0, 3]}}
+
+    DATA BEGINS HERE
+    {json.dumps([{"index": index, "payee": payee, "memo": memo, "description": description} for index, (payee, memo, description) in enumerate(signatures)])}'''
+
+    async with semaphore:
+        with span("llm", "classify_signatures"):
+            responses = await clients.llm_client.chat.completions.create(
+                model='Meta-Llama-3.1-405B-Instruct',
+                messages=[{"role": "system", "content": system_prompt}, {"role":"user", "content":user_prompt}]
             )
-            possible_fraud_instances.append(possible_fraud_instance)
 
-        return possible_fraud_instances
+    suspicious_indices = set(json.loads(responses.choices[0].message.content)['suspicious'])
+    verdicts = {signature: index in suspicious_indices for index, signature in enumerate(signatures)}
+    for signature, verdict in verdicts.items():
+        payee_verdict_cache.set(signature, verdict)
+    return verdicts
+
+# Runs across accounts, so each distinct signature is only classified once per scan
+@register_detector("suspicious_payee", timeout=float(os.environ.get("LLM_DETECTOR_TIMEOUT", 30)), scope="user")
+async def detect_suspicious_payee(batch: TransactionBatch) -> list[PossibleFraudInstance]:
+    # Only signatures without a cached verdict are sent to the LLM
+    signatures = list(zip(batch.payee, batch.memo, batch.description))
+    verdicts = {signature: payee_verdict_cache.get(signature) for signature in set(signatures)}
+    unseen_signatures = [signature for signature, verdict in verdicts.items() if verdict is None]
+    if unseen_signatures:
+        semaphore = asyncio.Semaphore(llm_max_concurrency)
+        chunks = chunk_by_token_budget(unseen_signatures, llm_batch_token_budget)
+        for chunk_verdicts in await asyncio.gather(*[classify_signatures(chunk, semaphore) for chunk in chunks]):
+            verdicts.update(chunk_verdicts)
+
+    possible_fraud_instances = [
+        PossibleFraudInstance(transactions=[transaction], fraud_type = "suspicious_payee")
+        for transaction, signature in zip(batch.transactions, signatures)
+        if verdicts[signature]
+    ]
+    return possible_fraud_instances
+
+large_p2p_threshold_cents = 100 * 100
+p2p_matcher = KeywordMatcher(['venmo', 'zelle', 'cash app', 'paypal', 'apple cash'])
+
+@register_detector("large_p2p")
+def detect_large_p2p(batch: TransactionBatch) -> list[PossibleFraudInstance]:
+    # Only transactions over the threshold need their text searched for a P2P service
+    candidates = np.flatnonzero(np.abs(batch.cents) >= large_p2p_threshold_cents)
+    flagged = np.flatnonzero(p2p_matcher.mask(batch, candidates))
+    possible_fraud_instances: list[PossibleFraudInstance] = [
+        PossibleFraudInstance(transactions = [transaction], fraud_type = "large_p2p")
+        for transaction in batch.select(flagged)
+    ]
+    return possible_fraud_instances
+
+
+#--------------#
+#   PIPELINE   #
+#--------------#
+
+# Batches at least this large are sent to the process pool for local detectors, rather than run on a thread
+# Below it, pickling the batch costs more than holding the GIL saves
+process_pool_min_transactions: int = int(os.environ.get("PROCESS_POOL_MIN_TRANSACTIONS", 50000))
 
+# Entry point for local detectors in the process pool, which has its own copy of the registry
+def run_local_detector(name: str, batch: TransactionBatch) -> list[PossibleFraudInstance]:
+    return detector_registry[name].func(batch)
 
+# Local detectors run on a worker thread, or another process for large batches, so they overlap with the LLM one
+async def call_detector(detector: Detector, batch: TransactionBatch) -> list[PossibleFraudInstance]:
+    if asyncio.iscoroutinefunction(detector.func):
+        return await detector.func(batch)
+    if batch.size >= process_pool_min_transactions:
+        return batch.attach(await run_in_process(run_local_detector, detector.name, batch.detach()))
+    return await asyncio.to_thread(detector.func, batch)
+
+# Runs every account's part of the detector concurrently, merging their results
+async def call_detector_per_account(detector: Detector, account_batches: list[TransactionBatch]) -> list[PossibleFraudInstance]:
+    account_results = await asyncio.gather(*[call_detector(detector, account_batch) for account_batch in account_batches])
+    return [possible_fraud_instance for results in account_results for possible_fraud_instance in results]
+
+# Runs a single detector, returning its results (or None if it failed) and its wall time in milliseconds
+async def run_detector(detector: Detector, batch: TransactionBatch, account_batches: list[TransactionBatch]) -> tuple[list[PossibleFraudInstance] | None, float]:
+    started = time.perf_counter()
+    try:
+        if detector.scope == "user":
+            pending = call_detector(detector, batch)
+        else:
+            pending = call_detector_per_account(detector, account_batches)
+        results = await asyncio.wait_for(pending, timeout=detector.timeout)
+    except Exception as e:
+        logger.warning("Detector failed", extra={ "detector": detector.name, "error": repr(e) })
+        results = None
+    elapsed = time.perf_counter() - started
+    record_stage("detector", detector.name, elapsed, failed=results is None)
+    return results, elapsed * 1000
+
+# Columns are built once and shared by every detector, including the per-account views of them
+def build_batches(transactions: list[Transaction]) -> tuple[TransactionBatch, list[TransactionBatch]]:
+    batch = TransactionBatch(transactions)
+    return batch, batch.split_by_account()
+
+# Runs every registered detector once, concurrently, and merges their results
+async def run_detectors(transactions: list[Transaction]) -> DetectionRun:
+    batch, account_batches = await run_off_loop(len(transactions), build_batches, transactions)
+    detectors = list(detector_registry.values())
+    outcomes = await asyncio.gather(*[run_detector(detector, batch, account_batches) for detector in detectors])
+
+    possible_fraud_instances: list[PossibleFraudInstance] = []
+    seen_instances = set()
+    detector_timings: dict[str, float] = {}
+    failed_detectors: list[str] = []
+    for detector, (results, elapsed) in zip(detectors, outcomes):
+        detector_timings[detector.name] = round(elapsed, 3)
+        if results is None:
+            failed_detectors.append(detector.name)
+            continue
+
+        # The same transactions flagged for the same reason are only reported once
+        for possible_fraud_instance in results:
+            instance_key = (possible_fraud_instance.fraud_type, tuple(sorted((t.account_id, t.id) for t in possible_fraud_instance.transactions)))
+            if instance_key not in seen_instances:
+                seen_instances.add(instance_key)
+                possible_fraud_instances.append(possible_fraud_instance)
+
+    return DetectionRun(
+        possible_fraud_instances=possible_fraud_instances,
+        detector_timings=detector_timings,
+        failed_detectors=failed_detectors
+    )
 
-def detect_all(transactions: list[Transaction]) -> list[PossibleFraudInstance]:
-    print()
-    print(detect_duplicates(transactions))
-    print()
-    print(detect_suspicious_payee(transactions))
-    print()
-    print(detect_large_p2p(transactions))
-    return detect_duplicates(transactions) + detect_suspicious_payee(transactions) + detect_large_p2p(transactions)
\ No newline at end of file
+# Formats a run's detector timings as a Server-Timing header value
+def server_timing_header(detection_run: DetectionRun) -> str:
+    return ", ".join(f"{name};dur={elapsed}" for name, elapsed in detection_run.detector_timings.items())
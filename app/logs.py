@@ -0,0 +1,41 @@
+import json
+import logging
+import os
+import random
+import sys
+
+# Log records as single-line JSON, at LOG_LEVEL and above
+# Records below WARNING are only kept at LOG_SAMPLE_RATE, so per-request logging stays cheap under load
+log_level: str = os.environ.get("LOG_LEVEL", "INFO").upper()
+log_sample_rate: float = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+# Attributes every LogRecord has, so anything else on a record was passed through extra= and is logged as a field
+standard_record_fields = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | { "message", "asctime", "taskName" }
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update({ key: value for key, value in vars(record).items() if key not in standard_record_fields })
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or log_sample_rate >= 1 or random.random() < log_sample_rate
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(log_level)
+
+    # The HTTP client logs every outbound request at INFO, which the stage metrics already cover
+    logging.getLogger("httpx").setLevel(logging.WARNING)
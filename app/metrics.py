@@ -0,0 +1,140 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+from cache import LRUCache
+
+logger = logging.getLogger("metrics")
+
+# Requests slower than this are always logged, regardless of log sampling
+slow_request_seconds: float = float(os.environ.get("SLOW_REQUEST_SECONDS", 2))
+
+# With several server workers, each writes its metrics to files in PROMETHEUS_MULTIPROC_DIR and /metrics reports all
+# of them together, whichever worker serves it. The directory has to be emptied before the workers start
+multiprocess_mode: bool = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# How often each worker publishes its cache statistics in multiprocess mode
+cache_metrics_interval_seconds: float = float(os.environ.get("CACHE_METRICS_INTERVAL", 15))
+
+request_duration = Histogram(
+    "pufferfish_request_duration_seconds",
+    "Time to fully send a response, including streamed bodies",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+request_exceptions = Counter(
+    "pufferfish_request_exceptions_total",
+    "Requests that raised an unhandled exception",
+    ["method", "route"]
+)
+
+# Stages are the parts of a request time goes to: auth, mongo, simplefin, parse, detector and llm
+# Operation says which call within the stage, e.g. stage "detector" and operation "duplicate"
+stage_duration = Histogram(
+    "pufferfish_stage_duration_seconds",
+    "Time spent in each stage of handling a request or background scan",
+    ["stage", "operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+stage_errors = Counter(
+    "pufferfish_stage_errors_total",
+    "Stages that raised an exception or failed",
+    ["stage", "operation"]
+)
+
+def record_stage(stage: str, operation: str, seconds: float, failed: bool = False):
+    stage_duration.labels(stage, operation).observe(seconds)
+    if failed:
+        stage_errors.labels(stage, operation).inc()
+
+# Times the enclosed block as a stage, counting it as an error if it raises
+@contextmanager
+def span(stage: str, operation: str):
+    started = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        record_stage(stage, operation, time.perf_counter() - started, failed)
+
+# Hit, miss and size counts of the in-process caches, summed over the running workers
+# The caches count on their own, and their counts are copied into these gauges when published
+cache_hits = Gauge("pufferfish_cache_hits", "Lookups served from an in-process cache", ["cache"], multiprocess_mode="livesum")
+cache_misses = Gauge("pufferfish_cache_misses", "Lookups an in-process cache could not serve", ["cache"], multiprocess_mode="livesum")
+cache_entries = Gauge("pufferfish_cache_entries", "Entries held by an in-process cache", ["cache"], multiprocess_mode="livesum")
+caches: dict[str, LRUCache] = {}
+cache_metrics_published_at = 0.0
+
+def register_cache(name: str, cache: LRUCache):
+    caches[name] = cache
+
+def publish_cache_metrics():
+    global cache_metrics_published_at
+
+    cache_metrics_published_at = time.monotonic()
+    for name, cache in caches.items():
+        cache_hits.labels(name).set(cache.hits)
+        cache_misses.labels(name).set(cache.misses)
+        cache_entries.labels(name).set(len(cache))
+
+def metrics_response() -> Response:
+    publish_cache_metrics()
+    if multiprocess_mode:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+# Lets the other workers know this one has stopped, so its gauges drop out of the sums
+def close_metrics():
+    if multiprocess_mode:
+        multiprocess.mark_process_dead(os.getpid())
+
+# ASGI middleware timing every HTTP request until its response has been fully sent
+# Requests are labelled by route template rather than path, so path parameters don't multiply the series
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Workers other than the one serving /metrics publish their cache statistics as they handle requests
+        if multiprocess_mode and time.monotonic() - cache_metrics_published_at > cache_metrics_interval_seconds:
+            publish_cache_metrics()
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception:
+            request_exceptions.labels(scope["method"], route_label(scope)).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            route = route_label(scope)
+            request_duration.labels(scope["method"], route, str(status)).observe(elapsed)
+            fields = { "method": scope["method"], "route": route, "status": status, "duration_ms": round(elapsed * 1000, 3) }
+            if elapsed >= slow_request_seconds:
+                logger.warning("Slow request", extra=fields)
+            else:
+                logger.info("Request", extra=fields)
+
+def route_label(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
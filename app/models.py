@@ -20,8 +20,12 @@ class UserAuthDetails(BaseModel):
     username: str
     password: str
 
+class SessionToken(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    expires_at: int
+
 class UserSimpleFINSetup(BaseModel):
-    auth_details: UserAuthDetails
     simplefin_setup_token: str
 
 class Transaction(BaseModel):
@@ -31,20 +35,64 @@ class Transaction(BaseModel):
     description: str
     payee: str
     memo: str
+    account_id: str | None = None
+
+class AccountSummary(BaseModel):
+    id: str
+    name: str
+    balance: str
+    available_balance: str | None = None # not every account reports one
+    currency: str
+    balance_date: int
 
 class FrontpageData(BaseModel):
     account_name: str
     balance: str
-    available_balance: str
+    available_balance: str | None = None # None if none of the totalled accounts report one
     currency: str
     balance_date: int
     recent_transactions: list[Transaction]
+    accounts: list[AccountSummary] = []
 
 class PossibleFraudInstance(BaseModel):
     transactions: list[Transaction]
-    fraud_type: str # duplicate, suspicious_payee, large_p2p
+    fraud_type: str # duplicate, suspicious_payee, large_p2p, amount_outlier, new_payee, velocity_spike
+
+class RunningStats(BaseModel):
+    # Welford's online mean and variance
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0 # sum of squared differences from the mean
+
+class PayeeProfile(BaseModel):
+    payee: str
+    amounts: RunningStats # in cents
+
+class BehaviorProfile(BaseModel):
+    version: int = 0
+    transaction_count: int = 0
+    last_posted: int = 0 # newest posted time processed so far
+    recent: list[tuple[int, str]] = [] # (posted, id) of processed transactions posted within the sync overlap of last_posted
+    payees: list[PayeeProfile] = []
+    velocity_bucket: int | None = None # time bucket transactions are currently being counted in
+    velocity_bucket_count: int = 0
+    velocity_alerted: bool = False # whether the current bucket has already been flagged
+    velocity: RunningStats = RunningStats() # transactions per completed bucket
+    recent_anomalies: list[PossibleFraudInstance] = []
+
+class DetectionRun(BaseModel):
+    possible_fraud_instances: list[PossibleFraudInstance]
+    detector_timings: dict[str, float] # wall time per detector, in milliseconds
+    failed_detectors: list[str] # detectors that errored or timed out, and so are missing from the results
+
+class FraudScan(DetectionRun):
+    scanned_at: int
+
+class DashboardData(BaseModel):
+    frontpage_data: FrontpageData
+    transactions: list[Transaction]
+    possible_fraud_instances: list[PossibleFraudInstance]
 
 class PossibleFraudSummarizeRequest(BaseModel):
-    auth_details: UserAuthDetails
     possible_fraud_instance: PossibleFraudInstance
     
\ No newline at end of file
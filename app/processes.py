@@ -0,0 +1,61 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Server worker processes, each with its own event loop, set the same way the Dockerfile sets uvicorn's --workers
+web_concurrency: int = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+# CPU-bound work that would hold the GIL for long can run on a pool of this many processes, one pool per server worker
+# Off by default, as server workers already use every core and the pool only takes detection on very large histories
+# Worth enabling when those histories are common, taking cores from the server workers via WEB_CONCURRENCY to match
+# 0 runs this work on threads instead
+cpu_pool_workers: int = int(os.environ.get("CPU_POOL_WORKERS", 0))
+
+# Parsing and column building over at least this many transactions runs on a worker thread rather than the event loop
+# It still holds the GIL, but the loop gets to serve other requests in between instead of stalling for the whole step
+offload_min_transactions: int = int(os.environ.get("OFFLOAD_MIN_TRANSACTIONS", 5000))
+
+# Access this as processes.process_pool, since it is only set once the app starts
+process_pool: ProcessPoolExecutor | None = None
+
+def import_modules(modules: tuple[str, ...]):
+    for module in modules:
+        importlib.import_module(module)
+
+# Opens the pool with every process started and the given modules imported, so no request waits on either
+def open_process_pool(preload: tuple[str, ...] = ()):
+    global process_pool
+
+    # Processes are spawned rather than forked, as forking a process with running threads and an event loop is unsafe
+    if cpu_pool_workers > 0:
+        process_pool = ProcessPoolExecutor(
+            max_workers=cpu_pool_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=import_modules,
+            initargs=(preload,)
+        )
+        # The pool only starts a process when a task finds none idle, so one quick task per process starts them all
+        for _ in range(cpu_pool_workers):
+            process_pool.submit(int)
+
+def close_process_pool():
+    global process_pool
+
+    if process_pool:
+        process_pool.shutdown(cancel_futures=True)
+        process_pool = None
+
+# Runs func(*args) over size transactions, on a worker thread if there are enough of them to stall the event loop
+async def run_off_loop(size: int, func, *args):
+    if size < offload_min_transactions:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+# Runs func(*args) on the process pool, or on a worker thread if there is no pool
+# func and its arguments must be picklable, so func has to be a module-level function
+async def run_in_process(func, *args):
+    if process_pool is None:
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.get_running_loop().run_in_executor(process_pool, func, *args)
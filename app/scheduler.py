@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import os
+import random
+import secrets
+import socket
+import time
+from pymongo.errors import DuplicateKeyError
+
+from models import *
+from detection import *
+from anomaly import *
+from store import *
+from metrics import span
+from processes import run_off_loop
+
+logger = logging.getLogger("scheduler")
+
+# How often each user is scanned in the background, and how far each user's scans are randomly spread out
+scan_interval_seconds: int = int(os.environ.get("FRAUD_SCAN_INTERVAL", 60 * 60))
+scan_jitter_seconds: int = int(os.environ.get("FRAUD_SCAN_JITTER", 5 * 60))
+
+# Scans running at once, and the retry delay after a failed scan, doubling per consecutive failure up to the maximum
+scan_concurrency: int = int(os.environ.get("FRAUD_SCAN_CONCURRENCY", 4))
+scan_retry_seconds: int = int(os.environ.get("FRAUD_SCAN_RETRY", 60))
+scan_max_backoff_seconds: int = int(os.environ.get("FRAUD_SCAN_MAX_BACKOFF", 6 * 60 * 60))
+
+# Stored results older than this are rescanned on request instead of returned
+scan_max_age_seconds: int = int(os.environ.get("FRAUD_SCAN_MAX_AGE", 2 * scan_interval_seconds))
+
+# How often the scheduler checks for users who are due a scan
+scheduler_tick_seconds: float = float(os.environ.get("FRAUD_SCAN_TICK", 30))
+
+# Only one server worker, across every instance, runs the scheduler at a time, by holding a lease in Mongo
+# The holder renews it every tick, and another worker takes over once it hasn't been renewed for this long
+scheduler_lease_seconds: float = float(os.environ.get("FRAUD_SCAN_LEASE", 3 * scheduler_tick_seconds))
+scheduler_lease_name = "fraud_scan_scheduler"
+
+# Takes or renews a lease, returning whether the owner now holds it
+# Whoever else holds an unexpired lease makes the upsert collide with their document, so the lease isn't taken
+async def acquire_lease(database, name: str, owner: str, lease_seconds: float) -> bool:
+    now = time.time()
+    try:
+        await database['leases'].update_one(
+            { "_id": name, "$or": [{ "owner": owner }, { "expires_at": { "$lt": now } }] },
+            { "$set": { "owner": owner, "expires_at": now + lease_seconds } },
+            upsert=True
+        )
+    except DuplicateKeyError as _e:
+        return False
+    return True
+
+async def release_lease(database, name: str, owner: str):
+    await database['leases'].delete_one({ "_id": name, "owner": owner })
+
+# Scans a user's data for possible fraud and stores the results as their latest scan
+# Callers that have just loaded the user's transactions can pass them in rather than have them loaded again
+# With force_sync, the transactions loaded are synced fresh from SimpleFIN rather than only if the last sync is stale
+async def scan_user(database, user_record: dict, transactions: list[Transaction] | None = None, force_sync: bool = False) -> FraudScan:
+    if transactions is None:
+        _accounts, transactions = await load_synced_data(database, user_record, force=force_sync)
+    detection_run = await run_detectors(transactions)
+
+    # Update the user's behavior profile with whatever is new since the last scan
+    started = time.perf_counter()
+    profile = await load_behavior_profile(database, user_record['_id'])
+    transactions_profiled = profile.transaction_count
+    await run_off_loop(len(transactions), update_behavior_profile, profile, transactions)
+    if profile.transaction_count != transactions_profiled:
+        await save_behavior_profile(database, user_record['_id'], profile)
+    detection_run.detector_timings["behavior"] = round((time.perf_counter() - started) * 1000, 3)
+
+    # Detectors that failed this time keep what they found in the previous scan rather than reporting nothing
+    # Detectors report their own name as the fraud type, so their earlier results are picked out by it
+    if detection_run.failed_detectors:
+        failed_detectors = set(detection_run.failed_detectors)
+        with span("mongo", "load_scan"):
+            previous_scan = await database['fraud_scans'].find_one({ "_id": user_record['_id'] }, projection={ "possible_fraud_instances": 1 })
+        detection_run.possible_fraud_instances.extend(
+            PossibleFraudInstance(**possible_fraud_instance)
+            for possible_fraud_instance in (previous_scan or {}).get('possible_fraud_instances', [])
+            if possible_fraud_instance['fraud_type'] in failed_detectors
+        )
+    detection_run.possible_fraud_instances.extend(profile.recent_anomalies)
+
+    fraud_scan = FraudScan(**detection_run.model_dump(), scanned_at=int(time.time()))
+    with span("mongo", "save_scan"):
+        await database['fraud_scans'].replace_one(
+            { "_id": user_record['_id'] },
+            fraud_scan.model_dump(),
+            upsert=True
+        )
+    return fraud_scan
+
+# Response headers saying when the fraud results were scanned, and which detectors' results are only from an earlier scan
+def fraud_scan_headers(fraud_scan: FraudScan) -> dict[str, str]:
+    headers = { "X-Scanned-At": str(fraud_scan.scanned_at) }
+    if fraud_scan.failed_detectors:
+        headers["X-Failed-Detectors"] = ",".join(fraud_scan.failed_detectors)
+    return headers
+
+# The user's latest stored scan, if it is recent enough to serve
+async def load_latest_scan(database, username: str) -> FraudScan | None:
+    with span("mongo", "load_scan"):
+        fraud_scan = await database['fraud_scans'].find_one({ "_id": username }, projection={ "_id": 0 })
+    if not fraud_scan or time.time() - fraud_scan['scanned_at'] > scan_max_age_seconds:
+        return None
+    return FraudScan(**fraud_scan)
+
+# Periodically scans every user with linked SimpleFIN data in the background
+class FraudScanScheduler:
+    def __init__(self, database):
+        self.database = database
+        self.semaphore = asyncio.Semaphore(scan_concurrency)
+        self.next_scan_at: dict[str, float] = {}
+        self.failures: dict[str, int] = {}
+        self.task: asyncio.Task | None = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+            # Hand over to another worker straight away rather than once the lease expires
+            await release_lease(self.database, scheduler_lease_name, self.owner)
+
+    async def run(self):
+        while True:
+            try:
+                if await acquire_lease(self.database, scheduler_lease_name, self.owner, scheduler_lease_seconds):
+                    await self.run_leased_scans()
+            except Exception:
+                logger.exception("Fraud scan scheduler tick failed")
+            await asyncio.sleep(scheduler_tick_seconds)
+
+    # Runs a round of scans, renewing the lease for as long as it takes
+    # The round is abandoned if another worker has taken the lease over, and cancelled along with the scheduler
+    async def run_leased_scans(self):
+        scans = asyncio.create_task(self.run_due_scans())
+        try:
+            while not (await asyncio.wait({ scans }, timeout=scheduler_tick_seconds))[0]:
+                if not await acquire_lease(self.database, scheduler_lease_name, self.owner, scheduler_lease_seconds):
+                    logger.warning("Lost the fraud scan scheduler lease, abandoning this round of scans")
+                    return
+            scans.result()
+        finally:
+            if not scans.done():
+                scans.cancel()
+                try:
+                    await scans
+                except asyncio.CancelledError:
+                    pass
+
+    async def run_due_scans(self):
+        now = time.time()
+        next_scan_at: dict[str, float] = {}
+        due_users: list[dict] = []
+        users = self.database['users'].find(
+            { "simplefin_access_url": { "$ne": None } },
+            projection={ "_id": 1, "simplefin_access_url": 1 }
+        )
+        async for user_record in users:
+            # Users seen for the first time get a random first scan time, so a restart doesn't scan everyone at once
+            username = user_record['_id']
+            next_scan_at[username] = self.next_scan_at.get(username, now + random.uniform(0, scan_jitter_seconds))
+            if next_scan_at[username] <= now:
+                due_users.append(user_record)
+
+        # Forget users who have since been removed or unlinked
+        self.next_scan_at = next_scan_at
+        self.failures = { username: count for username, count in self.failures.items() if username in next_scan_at }
+
+        await asyncio.gather(*[self.scan(user_record) for user_record in due_users])
+
+    async def scan(self, user_record: dict):
+        username = user_record['_id']
+        async with self.semaphore:
+            try:
+                # A scan with failed detectors is stored, but retried like a failed one until every detector succeeds
+                fraud_scan = await scan_user(self.database, user_record)
+                if fraud_scan.failed_detectors:
+                    raise RuntimeError(f"Detectors failed: {', '.join(fraud_scan.failed_detectors)}")
+                self.failures.pop(username, None)
+                delay = scan_interval_seconds
+            except Exception as e:
+                self.failures[username] = self.failures.get(username, 0) + 1
+                delay = min(scan_retry_seconds * 2 ** (self.failures[username] - 1), scan_max_backoff_seconds)
+                logger.warning("Fraud scan failed", extra={ "username": username, "retry_in_seconds": delay, "error": repr(e) })
+        self.next_scan_at[username] = time.time() + delay + random.uniform(0, scan_jitter_seconds)
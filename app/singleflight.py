@@ -0,0 +1,16 @@
+import asyncio
+
+# Lets concurrent callers asking for the same key share one in-flight call instead of each making their own
+class SingleFlight:
+    def __init__(self):
+        self.in_flight: dict[object, asyncio.Future] = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _f: self.in_flight.pop(key, None))
+
+        # Shielded so one caller disconnecting doesn't cancel the call for everyone else waiting on it
+        return await asyncio.shield(future)
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+import time
+from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from models import *
+from helpers import *
+from metrics import span
+from singleflight import SingleFlight
+from processes import run_off_loop
+
+logger = logging.getLogger("store")
+
+# How old a user's local copy of their SimpleFIN data may get before it is synced again
+sync_max_staleness: int = int(os.environ.get("SIMPLEFIN_MAX_STALENESS", 900))
+
+# Incremental syncs re-fetch a little before the last sync, as pending transactions can post late
+sync_overlap_seconds: int = int(os.environ.get("SIMPLEFIN_SYNC_OVERLAP", 3 * 24 * 60 * 60))
+
+# Account fields kept in the store, the second list being those SimpleFIN may leave out
+account_fields = ["id", "name", "currency", "balance", "balance-date"]
+optional_account_fields = ["available-balance"]
+
+# Concurrent requests for the same user share one sync
+sync_flight = SingleFlight()
+
+# Indexes backing the lookups below, created on startup
+async def create_store_indexes(database):
+    await database['transactions'].create_index(
+        [("username", ASCENDING), ("account_id", ASCENDING), ("id", ASCENDING)], unique=True
+    )
+    await database['transactions'].create_index(
+        [("username", ASCENDING), ("account_id", ASCENDING), ("posted", DESCENDING), ("id", DESCENDING)]
+    )
+    await database['transactions'].create_index(
+        [("username", ASCENDING), ("posted", DESCENDING), ("account_id", DESCENDING), ("id", DESCENDING)]
+    )
+    await database['accounts'].create_index([("username", ASCENDING), ("position", ASCENDING)])
+
+# Pull anything new from SimpleFIN into the local store, unless the local copy is still fresh
+# simplefin_access_url is the one the caller knows of, which may be out of date if the user has just relinked
+async def sync_transactions(database, username: str, simplefin_access_url: str, force: bool = False):
+    await sync_flight.do((username, simplefin_access_url, force), run_sync, database, username, simplefin_access_url, force)
+
+# The user's linked access URL, read from the users collection rather than a worker's user cache
+async def load_simplefin_access_url(database, username: str) -> str | None:
+    with span("mongo", "load_access_url"):
+        user_record = await database['users'].find_one({ "_id": username }, projection={ "simplefin_access_url": 1 })
+    return (user_record or {}).get('simplefin_access_url')
+
+async def run_sync(database, username: str, simplefin_access_url: str, force: bool = False):
+    with span("mongo", "load_sync_state"):
+        sync_state = await database['sync_state'].find_one({ "_id": username })
+    now = int(time.time())
+
+    # The sync state records the access URL the store was synced from, with states from before it was recorded assumed current
+    synced_url = sync_state.get('access_url', simplefin_access_url) if sync_state else None
+    if sync_state and not force and synced_url == simplefin_access_url and now - sync_state['synced_at'] < sync_max_staleness:
+        return
+
+    # Whatever the caller knows of, the sync is from the URL the user has linked now
+    # Data synced from a different one, e.g. by a sync still running when the user relinked, is replaced in full
+    simplefin_access_url = await load_simplefin_access_url(database, username)
+    if sync_state and sync_state.get('access_url', simplefin_access_url) != simplefin_access_url:
+        logger.info("Stored data is from a previously linked access URL, resyncing", extra={ "username": username })
+        await clear_synced_data(database, username)
+        sync_state = None
+    elif sync_state and not force and now - sync_state['synced_at'] < sync_max_staleness:
+        return
+
+    # Only ask SimpleFIN for the window since the last successful sync
+    start_date = sync_state['synced_at'] - sync_overlap_seconds if sync_state else None
+    try:
+        simplefin_data = await get_simplefin_data(simplefin_access_url, start_date=start_date)
+    except HTTPException as e:
+        # Serve the last good copy if there is one rather than failing the request
+        if not sync_state:
+            raise e
+        logger.warning("SimpleFIN sync failed, serving stored data", extra={ "username": username, "synced_at": sync_state['synced_at'], "detail": e.detail })
+        return
+
+    # Drop the data if the user relinked while it was being fetched, as it is from the account they unlinked
+    if await load_simplefin_access_url(database, username) != simplefin_access_url:
+        logger.info("Access URL changed during sync, dropping synced data", extra={ "username": username })
+        return
+
+    # Every account in the payload is ingested, each with its own concurrent write
+    await asyncio.gather(*[
+        ingest_account(database, username, position, account)
+        for position, account in enumerate(simplefin_data["accounts"])
+    ])
+    # A relink landing during the writes leaves this URL recorded against the new one, so the next sync replaces the data
+    await database['sync_state'].update_one(
+        { "_id": username },
+        { "$set": { "synced_at": now, "access_url": simplefin_access_url } },
+        upsert=True
+    )
+
+async def ingest_account(database, username: str, position: int, account: dict):
+    account_doc = { field: account[field] for field in account_fields }
+    account_doc.update({ field: account.get(field) for field in optional_account_fields })
+    account_doc["position"] = position
+    with span("mongo", "write_account"):
+        await database['accounts'].update_one({ "username": username, "id": account["id"] }, { "$set": account_doc }, upsert=True)
+
+    with span("parse", "import_transactions"):
+        transaction_docs = await run_off_loop(len(account["transactions"]), import_transaction_docs, account["transactions"])
+    transaction_operations = []
+    for transaction_doc in transaction_docs:
+        transaction_doc["account_id"] = account["id"]
+        transaction_operations.append(UpdateOne(
+            { "username": username, "account_id": account["id"], "id": transaction_doc["id"] },
+            { "$set": transaction_doc },
+            upsert=True
+        ))
+    if transaction_operations:
+        with span("mongo", "write_transactions"):
+            await database['transactions'].bulk_write(transaction_operations, ordered=False)
+
+def import_transaction_docs(transaction_dicts: list[dict]) -> list[dict]:
+    return transaction_list_adapter.dump_python(import_transactions_from_dict(transaction_dicts))
+
+# Forget a user's synced data and what was learned from it, e.g. after they link a different SimpleFIN account
+async def clear_synced_data(database, username: str):
+    await database['sync_state'].delete_one({ "_id": username })
+    await database['accounts'].delete_many({ "username": username })
+    await database['transactions'].delete_many({ "username": username })
+    await database['fraud_scans'].delete_one({ "_id": username })
+    await database['users'].update_one({ "_id": username }, { "$unset": { "behavior_profile": "" } })
+
+async def load_accounts(database, username: str) -> list[dict]:
+    cursor = database['accounts'].find({ "username": username }, projection={ "_id": 0, "username": 0 })
+    with span("mongo", "load_accounts"):
+        return await cursor.sort("position", ASCENDING).to_list(None)
+
+# Cursor over the user's transactions in the local store, across all accounts unless one is given, newest to oldest
+# Optionally limited to those posted in [start, end), and to those after a (posted, account id, id) position for paging
+def find_transactions(database, username: str, account_id: str | None = None, start: int | None = None, end: int | None = None,
+                      after: tuple[int, str, str] | None = None, limit: int | None = None):
+    query: dict = { "username": username }
+    if account_id is not None:
+        query["account_id"] = account_id
+    posted_range = {}
+    if start is not None:
+        posted_range["$gte"] = start
+    if end is not None:
+        posted_range["$lt"] = end
+    if posted_range:
+        query["posted"] = posted_range
+    if after is not None:
+        after_posted, after_account_id, after_id = after
+        query["$or"] = [
+            { "posted": { "$lt": after_posted } },
+            { "posted": after_posted, "account_id": { "$lt": after_account_id } },
+            { "posted": after_posted, "account_id": after_account_id, "id": { "$lt": after_id } }
+        ]
+
+    cursor = database['transactions'].find(query, projection={ "_id": 0, "username": 0 })
+    cursor = cursor.sort([("posted", DESCENDING), ("account_id", DESCENDING), ("id", DESCENDING)])
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return cursor
+
+# Transactions from the local store, newest to oldest, each carrying the id of its account
+async def load_transactions(database, username: str, account_id: str | None = None, **filters) -> list[Transaction]:
+    with span("mongo", "load_transactions"):
+        transaction_dicts = await find_transactions(database, username, account_id, **filters).to_list(None)
+    with span("parse", "load_transactions"):
+        return await run_off_loop(len(transaction_dicts), transaction_list_adapter.validate_python, transaction_dicts)
+
+# Bring the user's local copy of their SimpleFIN data up to date and get their accounts from it
+# With force, SimpleFIN is asked for new data even if the last sync is recent
+async def get_synced_accounts(database, user_record: dict, force: bool = False) -> list[dict]:
+    await sync_transactions(database, user_record['_id'], user_record['simplefin_access_url'], force)
+    accounts = await load_accounts(database, user_record['_id'])
+    if not accounts:
+        raise HTTPException(status_code=404, detail="No accounts found in SimpleFIN data")
+    return accounts
+
+# Same as above, along with the transactions of every account
+async def load_synced_data(database, user_record: dict, force: bool = False) -> tuple[list[dict], list[Transaction]]:
+    accounts = await get_synced_accounts(database, user_record, force)
+    transactions = await load_transactions(database, user_record['_id'])
+    return accounts, transactions
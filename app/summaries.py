@@ -0,0 +1,101 @@
+from datetime import datetime, timezone
+from fastapi.encoders import jsonable_encoder
+from typing import AsyncIterator
+import hashlib
+import json
+import os
+
+from models import *
+from cache import LRUCache
+from metrics import register_cache, span
+from singleflight import SingleFlight
+import clients
+
+# Summaries are cached in process, and optionally in Mongo so they survive restarts and are shared between instances
+summary_cache_ttl: int = int(os.environ.get("SUMMARY_CACHE_TTL", 7 * 24 * 60 * 60))
+summary_cache = LRUCache(maxsize=int(os.environ.get("SUMMARY_CACHE_SIZE", 10000)), ttl=summary_cache_ttl)
+register_cache("summaries", summary_cache)
+summary_cache_in_mongo: bool = os.environ.get("SUMMARY_CACHE_MONGO", "false").lower() in ("1", "true", "yes")
+
+# Concurrent requests to summarize the same instance share one completion
+summary_flight = SingleFlight()
+
+# Mongo expires cached summaries on its own through a TTL index
+async def create_summary_indexes(database):
+    if summary_cache_in_mongo:
+        await database['fraud_summaries'].create_index("created_at", expireAfterSeconds=summary_cache_ttl)
+
+# Hash of what the summary depends on, independent of the order the transactions were listed in
+def summary_key(possible_fraud_instance: PossibleFraudInstance) -> str:
+    content = {
+        "fraud_type": possible_fraud_instance.fraud_type,
+        "transactions": sorted((t.model_dump() for t in possible_fraud_instance.transactions), key=lambda t: (t["id"], t["posted"]))
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+async def get_cached_summary(database, key: str) -> str | None:
+    summary = summary_cache.get(key)
+    if summary is None and summary_cache_in_mongo:
+        cached_summary = await database['fraud_summaries'].find_one({ "_id": key })
+        if cached_summary:
+            summary = cached_summary['summary']
+            summary_cache.set(key, summary)
+    return summary
+
+async def cache_summary(database, key: str, summary: str):
+    summary_cache.set(key, summary)
+    if summary_cache_in_mongo:
+        await database['fraud_summaries'].update_one(
+            { "_id": key },
+            { "$set": { "summary": summary, "created_at": datetime.now(timezone.utc) } },
+            upsert=True
+        )
+
+def summary_messages(possible_fraud_instance: PossibleFraudInstance) -> list[dict]:
+    system_prompt = "You are a helpful AI fraud detection assistant, helping summarize possible instances of fraud in the user's bank transaction history"
+    user_prompt = f'''Based on the SimpleFIN transaction data in JSON format that is below the line \"DATA BEGINS HERE\", summarize in a short paragraph for an inexperienced user what factors make the transaction(s) appear to be fraudulent, and what the user can do to remedy the situation.
+
+    DATA BEGINS HERE
+    {jsonable_encoder(possible_fraud_instance)}'''
+    return [{"role": "system", "content": system_prompt}, {"role":"user", "content":user_prompt}]
+
+async def generate_summary(database, key: str, possible_fraud_instance: PossibleFraudInstance) -> str:
+    with span("llm", "summary"):
+        responses = await clients.llm_client.chat.completions.create(
+            model='Meta-Llama-3.1-405B-Instruct',
+            messages=summary_messages(possible_fraud_instance)
+        )
+    summary = responses.choices[0].message.content
+    await cache_summary(database, key, summary)
+    return summary
+
+async def summarize_fraud_instance(database, possible_fraud_instance: PossibleFraudInstance) -> str:
+    key = summary_key(possible_fraud_instance)
+    summary = await get_cached_summary(database, key)
+    if summary is None:
+        summary = await summary_flight.do(key, generate_summary, database, key, possible_fraud_instance)
+    return summary
+
+# Yields the summary piece by piece as the LLM produces it, or all at once if it is already cached
+async def stream_fraud_instance_summary(database, possible_fraud_instance: PossibleFraudInstance) -> AsyncIterator[str]:
+    key = summary_key(possible_fraud_instance)
+    summary = await get_cached_summary(database, key)
+    if summary is not None:
+        yield summary
+        return
+
+    # Timed until the last piece arrives, so a client disconnecting part way through counts as a failed stream
+    pieces: list[str] = []
+    with span("llm", "summary_stream"):
+        chunks = await clients.llm_client.chat.completions.create(
+            model='Meta-Llama-3.1-405B-Instruct',
+            messages=summary_messages(possible_fraud_instance),
+            stream=True
+        )
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+
+    # Only a summary that was streamed to completion is cached
+    await cache_summary(database, key, "".join(pieces))
@@ -0,0 +1,42 @@
+import os
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import DuplicateKeyError
+
+from models import *
+from cache import LRUCache
+from metrics import span
+
+# The fields of a user document the API reads
+user_projection = { "_id": 1, "password_hash": 1, "friendly_name": 1, "simplefin_access_url": 1 }
+
+# Access to the users collection through an in-process cache, kept in step with this process's writes
+class UserRepository:
+    def __init__(self, collection):
+        self.collection = collection
+        self.cache = LRUCache(
+            maxsize=int(os.environ.get("USER_CACHE_SIZE", 10000)),
+            ttl=float(os.environ.get("USER_CACHE_TTL", 60))
+        )
+
+    async def get(self, username: str) -> dict | None:
+        user_record = self.cache.get(username)
+        if user_record is None:
+            with span("mongo", "get_user"):
+                user_record = await self.collection.find_one({ "_id": username }, projection=user_projection)
+            if user_record:
+                self.cache.set(username, user_record)
+        return user_record
+
+    async def create(self, user: DBUser) -> dict:
+        user_record = jsonable_encoder(user)
+        try:
+            await self.collection.insert_one(user_record)
+        except DuplicateKeyError as _e:
+            raise HTTPException(status_code=409, detail="Username is already taken")
+        self.cache.set(user_record['_id'], user_record)
+        return user_record
+
+    async def set_simplefin_access_url(self, username: str, simplefin_access_url: str):
+        await self.collection.update_one({ "_id": username }, { "$set": { "simplefin_access_url": simplefin_access_url } })
+        self.cache.pop(username)
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from openai import AsyncOpenAI
+
+from synthetic import *
+from stand_ins import *
+from report import *
+
+# Microbenchmarks for each stage of a fraud scan and each registered detector, on synthetic histories of increasing size
+# The LLM detector is timed against the fake LLM, both with an empty verdict cache and with every verdict cached
+#
+#   python bench/detectors.py --sizes 1000 100000 1000000 --repeat 5
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+from helpers import import_transactions_from_dict
+from detection import *
+import clients
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark each stage of a fraud scan and each registered detector")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 1000, 10000, 100000], help="transactions per user")
+    parser.add_argument("--accounts", type=int, default=1, help="accounts the transactions are spread over")
+    parser.add_argument("--fraud-rate", type=float, default=0.01, help="share of transactions that are planted frauds")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each stage")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds the fake LLM takes to answer")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="seconds the fake LLM's latency varies by")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+# Times func over repeat runs, calling before_each untimed ahead of every run, returning the timings and the last result
+async def time_runs(func, repeat: int, before_each=None) -> tuple[list[float], object]:
+    timings: list[float] = []
+    result = None
+    for _ in range(repeat):
+        if before_each:
+            before_each()
+        started = time.perf_counter()
+        result = func()
+        if asyncio.iscoroutine(result):
+            result = await result
+        timings.append(time.perf_counter() - started)
+    return timings, result
+
+def timing_row(size: int, stage: str, timings: list[float], recall: dict[str, float] | None = None) -> dict:
+    return {
+        "size": size,
+        "stage": stage,
+        "runs": len(timings),
+        "min ms": f"{min(timings) * 1000:.2f}",
+        "median ms": f"{statistics.median(timings) * 1000:.2f}",
+        "transactions/s": f"{size / min(timings):,.0f}",
+        "planted found": format_recall(recall) if recall is not None else ""
+    }
+
+def parse_transactions(simplefin_data: dict) -> list[Transaction]:
+    transactions: list[Transaction] = []
+    for account in simplefin_data["accounts"]:
+        for transaction in import_transactions_from_dict(account["transactions"]):
+            transaction.account_id = account["id"]
+            transactions.append(transaction)
+    return transactions
+
+def clear_verdict_cache():
+    payee_verdict_cache.entries.clear()
+
+async def benchmark_size(args: argparse.Namespace, size: int) -> list[dict]:
+    simplefin_data, planted = generate_simplefin_data(size, args.accounts, args.fraud_rate)
+    rows: list[dict] = []
+
+    timings, transactions = await time_runs(lambda: parse_transactions(simplefin_data), args.repeat)
+    rows.append(timing_row(size, "parse", timings))
+    timings, batch = await time_runs(lambda: TransactionBatch(transactions), args.repeat)
+    rows.append(timing_row(size, "batch", timings))
+    timings, account_batches = await time_runs(batch.split_by_account, args.repeat)
+    rows.append(timing_row(size, "split by account", timings))
+
+    # Each detector on its own, called directly rather than through the pipeline's thread and timeout handling
+    for detector in detector_registry.values():
+        def run_detector_directly(detector=detector):
+            if detector.scope == "user":
+                return call_detector(detector, batch)
+            return call_detector_per_account(detector, account_batches)
+
+        # Detectors are named after the fraud type they report
+        detector_planted = [instance for instance in planted if instance[0] == detector.name]
+        if asyncio.iscoroutinefunction(detector.func):
+            timings, results = await time_runs(run_detector_directly, args.repeat, before_each=clear_verdict_cache)
+            rows.append(timing_row(size, f"{detector.name} (uncached)", timings, planted_recall(detector_planted, results)))
+            timings, results = await time_runs(run_detector_directly, args.repeat)
+            rows.append(timing_row(size, f"{detector.name} (cached)", timings, planted_recall(detector_planted, results)))
+        else:
+            timings, results = await time_runs(run_detector_directly, args.repeat)
+            rows.append(timing_row(size, detector.name, timings, planted_recall(detector_planted, results)))
+
+    # The whole pipeline as a scan runs it, from parsed transactions to merged results
+    timings, detection_run = await time_runs(lambda: run_detectors(transactions), args.repeat, before_each=clear_verdict_cache)
+    rows.append(timing_row(size, "run_detectors (uncached)", timings, planted_recall(planted, detection_run.possible_fraud_instances)))
+    return rows
+
+async def benchmark(args: argparse.Namespace, llm_url: str) -> list[dict]:
+    clients.llm_client = AsyncOpenAI(api_key="bench", base_url=f"{llm_url}/v1")
+    rows: list[dict] = []
+    try:
+        for size in args.sizes:
+            print(f"Benchmarking {size} transactions")
+            rows.extend(await benchmark_size(args, size))
+    finally:
+        await clients.llm_client.close()
+    return rows
+
+def main():
+    args = parse_args()
+    llm_server = BackgroundServer(llm_app(args.llm_latency, args.llm_jitter))
+    llm_url = llm_server.start()
+    try:
+        rows = asyncio.run(benchmark(args, llm_url))
+    finally:
+        llm_server.stop()
+
+    print()
+    print_table(rows)
+    write_json(args.json, { "arguments": vars(args), "results": rows })
+
+if __name__ == "__main__":
+    main()
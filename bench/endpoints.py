@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import base64
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import httpx
+
+from synthetic import *
+from stand_ins import *
+from report import *
+
+# Benchmarks the API's data endpoints end to end over HTTP, against synthetic SimpleFIN data of increasing size
+# SimpleFIN Bridge and the LLM are replaced by local stand-ins, and Mongo by an in-memory one unless --mongo-uri is given
+#
+#   python bench/endpoints.py --sizes 50 1000 10000 --llm-latency 0.5
+
+app_path = os.path.join(os.path.dirname(__file__), "..", "app")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the API's data endpoints against local stand-in services")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 1000, 10000], help="transactions per user")
+    parser.add_argument("--accounts", type=int, default=1, help="accounts the transactions are spread over")
+    parser.add_argument("--fraud-rate", type=float, default=0.01, help="share of transactions that are planted frauds")
+    parser.add_argument("--requests", type=int, default=200, help="requests per light endpoint")
+    parser.add_argument("--heavy-requests", type=int, default=20, help="requests per endpoint returning or scanning the whole history")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds the fake LLM takes to answer")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="seconds the fake LLM's latency varies by")
+    parser.add_argument("--mongo-uri", help="benchmark against this Mongo instead of the in-memory one")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+# Endpoints measured for every size, as (label, path, query params, heavy)
+scenarios = [
+    ("frontpage", "/frontpage_data", {}, False),
+    ("transactions page", "/transactions", { "limit": 100 }, False),
+    ("transactions all", "/transactions", {}, True),
+    ("transactions stream", "/transactions", { "stream": "true" }, True),
+    ("detect_fraud stored", "/detect_fraud", {}, False),
+    ("detect_fraud refresh", "/detect_fraud", { "refresh": "true" }, True)
+]
+
+async def timed_request(client: httpx.AsyncClient, path: str, params: dict, headers: dict) -> float:
+    started = time.perf_counter()
+    response = await client.post(path, params=params, headers=headers)
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+# Peak memory traced while serving a single request, across every thread in the process
+async def request_peak_memory(client: httpx.AsyncClient, path: str, params: dict, headers: dict) -> int:
+    tracemalloc.start()
+    try:
+        await timed_request(client, path, params, headers)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+async def run_load(client: httpx.AsyncClient, path: str, params: dict, headers: dict, count: int, concurrency: int) -> tuple[list[float], float]:
+    latencies: list[float] = []
+    remaining = iter(range(count))
+
+    async def worker():
+        for _ in remaining:
+            latencies.append(await timed_request(client, path, params, headers))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, count))])
+    return latencies, time.perf_counter() - started
+
+# Creates a user and links them to a dataset on the fake SimpleFIN server through the app's setup flow
+async def create_linked_user(client: httpx.AsyncClient, simplefin_url: str, dataset: str) -> dict:
+    credentials = { "username": f"bench-{dataset}", "password": "bench-password" }
+    response = await client.post("/create_user", json={ **credentials, "friendly_name": "Bench" })
+    if response.status_code != 409:
+        response.raise_for_status()
+    response = await client.post("/login", json=credentials)
+    response.raise_for_status()
+    headers = { "Authorization": f"Bearer {response.json()['access_token']}" }
+
+    setup_token = base64.b64encode(f"{simplefin_url}/claim/{dataset}".encode()).decode()
+    response = await client.post("/setup_simplefin", json={ "simplefin_setup_token": setup_token }, headers=headers)
+    response.raise_for_status()
+    return headers
+
+async def benchmark(args: argparse.Namespace, app_url: str, simplefin_url: str, planted_by_dataset: dict) -> list[dict]:
+    rows: list[dict] = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=app_url, timeout=None, limits=limits) as client:
+        for size in args.sizes:
+            dataset = f"n{size}"
+            headers = await create_linked_user(client, simplefin_url, dataset)
+
+            # The first request pulls the whole history from SimpleFIN into the store
+            cold_sync = await timed_request(client, "/frontpage_data", {}, headers)
+            rows.append({
+                "size": size, "endpoint": "cold sync", "requests": 1, "p50 ms": f"{cold_sync * 1000:.1f}",
+                "p99 ms": f"{cold_sync * 1000:.1f}", "req/s": "", "peak mem/req": ""
+            })
+
+            for label, path, params, heavy in scenarios:
+                count = args.heavy_requests if heavy else args.requests
+                peak_memory = await request_peak_memory(client, path, params, headers)
+                latencies, elapsed = await run_load(client, path, params, headers, count, args.concurrency)
+                rows.append({
+                    "size": size,
+                    "endpoint": label,
+                    "requests": count,
+                    "p50 ms": f"{percentile(latencies, 0.5) * 1000:.1f}",
+                    "p99 ms": f"{percentile(latencies, 0.99) * 1000:.1f}",
+                    "req/s": f"{count / elapsed:.1f}",
+                    "peak mem/req": format_bytes(peak_memory)
+                })
+
+            # Planted frauds the API found, as a check that the timings are of a scan that works
+            response = await client.post("/detect_fraud", headers=headers)
+            recall = planted_recall(planted_by_dataset[dataset], response.json())
+            print(f"{size} transactions: planted fraud recall {format_recall(recall)}")
+    return rows
+
+def main():
+    args = parse_args()
+
+    print(f"Generating datasets of {', '.join(map(str, args.sizes))} transactions")
+    datasets: dict[str, dict] = {}
+    planted_by_dataset: dict[str, list] = {}
+    for size in args.sizes:
+        datasets[f"n{size}"], planted_by_dataset[f"n{size}"] = generate_simplefin_data(size, args.accounts, args.fraud_rate)
+
+    # The fake SimpleFIN server needs its own URL to hand out access URLs, which it only has once started
+    simplefin_base_url: dict = {}
+    simplefin_server = BackgroundServer(simplefin_app(datasets, simplefin_base_url))
+    simplefin_base_url["url"] = simplefin_server.start()
+    llm_server = BackgroundServer(llm_app(args.llm_latency, args.llm_jitter))
+    llm_url = llm_server.start()
+
+    # The app reads its configuration from the environment, so it is set before the app is imported
+    os.environ.update({
+        "ATLAS_URI": args.mongo_uri or "",
+        "DB_NAME": f"pufferfish_bench_{int(time.time())}",
+        "LLM_API_KEY": "bench",
+        "LLM_BASE_URL": f"{llm_url}/v1",
+        "FRAUD_SCAN_SCHEDULER": "false"
+    })
+    sys.path.insert(0, app_path)
+    import api
+    if not args.mongo_uri:
+        api.AsyncMongoClient = InMemoryMongoClient
+    app_server = BackgroundServer(api.app, lifespan="on")
+    app_url = app_server.start()
+
+    try:
+        rows = asyncio.run(benchmark(args, app_url, simplefin_base_url["url"], planted_by_dataset))
+    finally:
+        app_server.stop()
+        llm_server.stop()
+        simplefin_server.stop()
+
+    print()
+    print_table(rows)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(f"Peak RSS of the whole benchmark process: {format_bytes(peak_rss)}")
+    write_json(args.json, { "arguments": vars(args), "results": rows, "peak_rss_bytes": peak_rss })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import json
+import math
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)] if ordered else float("nan")
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+# Prints rows of dicts as an aligned text table, in the order of the first row's keys
+def print_table(rows: list[dict]):
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [[str(row.get(column, "")) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(row[index]) for row in cells)) for index, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    print("  ".join("-" * width for width in widths))
+    for row in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    print()
+
+def write_json(path: str | None, results: dict):
+    if path:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote results to {path}")
+
+def format_recall(recall: dict[str, float]) -> str:
+    return ", ".join(f"{fraud_type} {share:.0%}" for fraud_type, share in sorted(recall.items())) or "no planted frauds"
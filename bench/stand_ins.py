@@ -0,0 +1,410 @@
+import asyncio
+import copy
+import heapq
+import json
+import random
+import threading
+import time
+from functools import cmp_to_key
+from types import SimpleNamespace
+
+import uvicorn
+from pymongo.errors import DuplicateKeyError
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from synthetic import suspicious_payees
+
+#-------------------------#
+#   IN-MEMORY MONGO       #
+#-------------------------#
+
+# Just enough of pymongo's async API for the app, without a server
+# Lookups on a unique index's fields are hash lookups, and other queries only scan documents sharing the value of
+# an index's first field (the username), so large histories behave roughly like an indexed collection would
+# Unsupported query or update operators raise rather than silently matching the wrong documents
+
+missing = object()
+
+# Documents are copied on the way in and out, like they would be going over the wire, but flat values are shared
+def clone(value):
+    return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+def get_path(document: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(document, dict) or part not in document:
+            return missing
+        document = document[part]
+    return document
+
+def matches_condition(value, condition) -> bool:
+    if not isinstance(condition, dict) or not any(key.startswith("$") for key in condition):
+        return value is not missing and value == condition
+    for operator, operand in condition.items():
+        if operator == "$ne":
+            if value is not missing and value == operand or value is missing and operand is None:
+                return False
+        elif operator == "$exists":
+            if (value is not missing) != bool(operand):
+                return False
+        elif operator == "$in":
+            if value is missing or value not in operand:
+                return False
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            if value is missing or value is None:
+                return False
+            if operator == "$gt" and not value > operand or operator == "$gte" and not value >= operand:
+                return False
+            if operator == "$lt" and not value < operand or operator == "$lte" and not value <= operand:
+                return False
+        else:
+            raise NotImplementedError(f"Query operator {operator} is not supported by the in-memory Mongo")
+    return True
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Query operator {key} is not supported by the in-memory Mongo")
+        elif not matches_condition(get_path(document, key), condition):
+            return False
+    return True
+
+def project(document: dict, projection: dict | None) -> dict:
+    if not projection:
+        return { field: clone(value) for field, value in document.items() }
+    included = [field for field, flag in projection.items() if flag and field != "_id"]
+    if included:
+        result = { field: clone(document[field]) for field in included if field in document }
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+    return { field: clone(value) for field, value in document.items() if projection.get(field, 1) }
+
+def apply_update(document: dict, update: dict):
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            *parents, field = path.split(".")
+            target = document
+            for part in parents:
+                target = target.setdefault(part, {})
+            if operator == "$set":
+                target[field] = clone(value)
+            elif operator == "$unset":
+                target.pop(field, None)
+            else:
+                raise NotImplementedError(f"Update operator {operator} is not supported by the in-memory Mongo")
+
+# Missing values sort first, as in Mongo
+def sort_value(document: dict, field: str) -> tuple:
+    value = document.get(field)
+    return (value is not None, value)
+
+def sort_key_compare(sort: list[tuple[str, int]]):
+    def compare(a: dict, b: dict) -> int:
+        for field, direction in sort:
+            a_value, b_value = sort_value(a, field), sort_value(b, field)
+            if a_value != b_value:
+                return -direction if a_value < b_value else direction
+        return 0
+    return cmp_to_key(compare)
+
+# Full sorts are one stable sort per field, least significant first, which is much faster than comparing field by field
+def sort_documents(documents: list[dict], sort: list[tuple[str, int]]) -> list[dict]:
+    for field, direction in reversed(sort):
+        documents.sort(key=lambda document: sort_value(document, field), reverse=direction < 0)
+    return documents
+
+class InMemoryCursor:
+    def __init__(self, collection: "InMemoryCollection", query: dict, projection: dict | None):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_fields: list[tuple[str, int]] = []
+        self.limit_count = 0
+        self.results = None
+
+    def sort(self, key, direction: int | None = None):
+        self.sort_fields = [(key, direction or 1)] if isinstance(key, str) else list(key)
+        return self
+
+    def limit(self, count: int):
+        self.limit_count = count
+        return self
+
+    def evaluate(self) -> list[dict]:
+        documents = [document for document in self.collection.candidates(self.query) if matches(document, self.query)]
+        if self.sort_fields and self.limit_count:
+            documents = heapq.nsmallest(self.limit_count, documents, key=sort_key_compare(self.sort_fields))
+        elif self.sort_fields:
+            documents = sort_documents(documents, self.sort_fields)
+        elif self.limit_count:
+            documents = documents[:self.limit_count]
+        return [project(document, self.projection) for document in documents]
+
+    async def to_list(self, length: int | None = None) -> list[dict]:
+        return self.evaluate()
+
+    def __aiter__(self):
+        self.results = iter(self.evaluate())
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self.results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.results = None
+
+class InMemoryCollection:
+    def __init__(self):
+        self.documents: dict = {}
+        self.next_id = 0
+        self.unique_indexes: dict[tuple[str, ...], dict] = {}
+        self.partition_field: str | None = None
+        self.partitions: dict = {}
+
+    async def create_index(self, keys, unique: bool = False, **kwargs):
+        fields = (keys,) if isinstance(keys, str) else tuple(field for field, _direction in keys)
+        if unique and fields not in self.unique_indexes:
+            self.unique_indexes[fields] = { self.index_key(document, fields): _id for _id, document in self.documents.items() }
+        if self.partition_field is None and not self.documents:
+            self.partition_field = fields[0]
+        return "_".join(fields)
+
+    def index_key(self, document: dict, fields: tuple[str, ...]) -> tuple:
+        return tuple(document.get(field) for field in fields)
+
+    # Documents that could match the query, found through an index where possible
+    def candidates(self, query: dict) -> list[dict]:
+        if "_id" in query and not isinstance(query["_id"], dict):
+            document = self.documents.get(query["_id"])
+            return [document] if document is not None else []
+        for fields, index in self.unique_indexes.items():
+            if set(fields) == { key for key in query if not isinstance(query[key], dict) and not key.startswith("$") }:
+                _id = index.get(tuple(query[field] for field in fields))
+                return [self.documents[_id]] if _id is not None else []
+        if self.partition_field in query and not isinstance(query[self.partition_field], dict):
+            return [self.documents[_id] for _id in self.partitions.get(query[self.partition_field], ())]
+        return list(self.documents.values())
+
+    def find_matching(self, query: dict) -> dict | None:
+        return next((document for document in self.candidates(query) if matches(document, query)), None)
+
+    def add(self, document: dict):
+        if "_id" not in document:
+            self.next_id += 1
+            document["_id"] = self.next_id
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError(f"Duplicate _id {document['_id']!r}")
+        for fields, index in self.unique_indexes.items():
+            if self.index_key(document, fields) in index:
+                raise DuplicateKeyError(f"Duplicate key for index on {fields}")
+        for fields, index in self.unique_indexes.items():
+            index[self.index_key(document, fields)] = document["_id"]
+        if self.partition_field:
+            self.partitions.setdefault(document.get(self.partition_field), {})[document["_id"]] = None
+        self.documents[document["_id"]] = document
+
+    def remove(self, document: dict):
+        for fields, index in self.unique_indexes.items():
+            index.pop(self.index_key(document, fields), None)
+        if self.partition_field:
+            self.partitions.get(document.get(self.partition_field), {}).pop(document["_id"], None)
+        del self.documents[document["_id"]]
+
+    def update(self, query: dict, update: dict, upsert: bool) -> SimpleNamespace:
+        document = self.find_matching(query)
+        if document is None:
+            if not upsert:
+                return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+            document = { key: clone(value) for key, value in query.items() if not isinstance(value, dict) and not key.startswith("$") }
+            apply_update(document, update)
+            self.add(document)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=document["_id"])
+        updated = { field: clone(value) for field, value in document.items() }
+        apply_update(updated, update)
+        self.remove(document)
+        try:
+            self.add(updated)
+        except DuplicateKeyError:
+            self.add(document)
+            raise
+        return SimpleNamespace(matched_count=1, modified_count=int(updated != document), upserted_id=None)
+
+    async def find_one(self, query: dict | None = None, projection: dict | None = None) -> dict | None:
+        document = self.find_matching(query or {})
+        return project(document, projection) if document is not None else None
+
+    def find(self, query: dict | None = None, projection: dict | None = None) -> InMemoryCursor:
+        return InMemoryCursor(self, query or {}, projection)
+
+    async def insert_one(self, document: dict) -> SimpleNamespace:
+        stored = copy.deepcopy(document)
+        self.add(stored)
+        document["_id"] = stored["_id"]
+        return SimpleNamespace(inserted_id=stored["_id"])
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False) -> SimpleNamespace:
+        return self.update(query, update, upsert)
+
+    async def replace_one(self, query: dict, replacement: dict, upsert: bool = False) -> SimpleNamespace:
+        document = self.find_matching(query)
+        if document is not None:
+            self.remove(document)
+        elif not upsert:
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+        stored = copy.deepcopy(replacement)
+        stored["_id"] = document["_id"] if document is not None else query.get("_id", replacement.get("_id"))
+        if stored["_id"] is None:
+            del stored["_id"]
+        self.add(stored)
+        return SimpleNamespace(matched_count=int(document is not None), modified_count=int(document is not None), upserted_id=None)
+
+    async def bulk_write(self, operations: list, ordered: bool = True) -> SimpleNamespace:
+        # Only UpdateOne is used by the app, and its fields are only reachable through pymongo's private attributes
+        for operation in operations:
+            self.update(operation._filter, operation._doc, operation._upsert)
+        return SimpleNamespace(acknowledged=True)
+
+    async def delete_one(self, query: dict) -> SimpleNamespace:
+        document = self.find_matching(query)
+        if document is not None:
+            self.remove(document)
+        return SimpleNamespace(deleted_count=int(document is not None))
+
+    async def delete_many(self, query: dict) -> SimpleNamespace:
+        documents = [document for document in self.candidates(query) if matches(document, query)]
+        for document in documents:
+            self.remove(document)
+        return SimpleNamespace(deleted_count=len(documents))
+
+class InMemoryDatabase:
+    def __init__(self):
+        self.collections: dict[str, InMemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        return self.collections.setdefault(name, InMemoryCollection())
+
+# Drop-in for pymongo's AsyncMongoClient, ignoring the connection string
+class InMemoryMongoClient:
+    def __init__(self, *args, **kwargs):
+        self.databases: dict[str, InMemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> InMemoryDatabase:
+        return self.databases.setdefault(name, InMemoryDatabase())
+
+    async def close(self):
+        pass
+
+
+#------------------------#
+#   FAKE SIMPLEFIN       #
+#------------------------#
+
+# Serves named SimpleFIN payloads at /simplefin/{dataset}/accounts, honouring start-date like SimpleFIN Bridge does
+# Claiming /claim/{dataset} returns that dataset's access URL, so the app's setup flow can be exercised as well
+def simplefin_app(datasets: dict[str, dict], base_url: dict) -> Starlette:
+    # Full payloads are serialized up front so the stand-in doesn't dominate cold sync timings
+    serialized = { name: json.dumps(data).encode() for name, data in datasets.items() }
+
+    async def claim(request: Request) -> Response:
+        dataset = request.path_params["dataset"]
+        if dataset not in datasets:
+            return PlainTextResponse("Unknown token", status_code=403)
+        scheme, host = base_url["url"].split("://")
+        return PlainTextResponse(f"{scheme}://bench:bench@{host}/simplefin/{dataset}")
+
+    async def accounts(request: Request) -> Response:
+        dataset = request.path_params["dataset"]
+        if dataset not in datasets:
+            return PlainTextResponse("Forbidden", status_code=403)
+        start_date = request.query_params.get("start-date")
+        if start_date is None:
+            return Response(serialized[dataset], media_type="application/json")
+        start_date = int(start_date)
+        data = dict(datasets[dataset], accounts=[
+            dict(account, transactions=[t for t in account["transactions"] if t["posted"] >= start_date])
+            for account in datasets[dataset]["accounts"]
+        ])
+        return JSONResponse(data)
+
+    return Starlette(routes=[
+        Route("/claim/{dataset}", claim, methods=["POST"]),
+        Route("/simplefin/{dataset}/accounts", accounts, methods=["GET"])
+    ])
+
+
+#------------------#
+#   FAKE LLM       #
+#------------------#
+
+# OpenAI compatible chat completions endpoint that answers after latency seconds, give or take jitter
+# Payee classification prompts get the indices of payees in suspicious_payees, anything else gets a fixed summary
+def llm_app(latency: float = 0.5, jitter: float = 0.1, seed: int = 0) -> Starlette:
+    rng = random.Random(seed)
+    markers = [payee.lower() for payee in suspicious_payees]
+    summary = "These transactions look unusual for this account. Contact your bank to dispute any you don't recognize."
+
+    def answer(messages: list[dict]) -> str:
+        prompt = messages[-1]["content"]
+        if '"suspicious"' not in prompt:
+            return summary
+        signatures = json.loads(prompt.rsplit("DATA BEGINS HERE", 1)[1])
+        return json.dumps({ "suspicious": [s["index"] for s in signatures if any(marker in s["payee"] for marker in markers)] })
+
+    async def chat_completions(request: Request) -> Response:
+        body = await request.json()
+        await asyncio.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+        content = answer(body["messages"])
+        completion_id = f"chatcmpl-{rng.getrandbits(32):08x}"
+        created = int(time.time())
+        if not body.get("stream"):
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": body["model"],
+                "choices": [{ "index": 0, "message": { "role": "assistant", "content": content }, "finish_reason": "stop" }]
+            })
+
+        async def chunks():
+            for piece in content.split(" "):
+                chunk = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body["model"],
+                    "choices": [{ "index": 0, "delta": { "content": piece + " " }, "finish_reason": None }]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    return Starlette(routes=[Route("/v1/chat/completions", chat_completions, methods=["POST"])])
+
+
+#-------------------------#
+#   BACKGROUND SERVERS    #
+#-------------------------#
+
+# Runs an ASGI app with uvicorn on its own thread and event loop, on a free local port
+class BackgroundServer:
+    def __init__(self, app, lifespan: str = "auto"):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan=lifespan))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url: str | None = None
+
+    def start(self) -> str:
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("Server failed to start")
+            time.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
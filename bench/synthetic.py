@@ -0,0 +1,125 @@
+import copy
+import json
+import os
+import random
+
+# Ordinary transactions are varied copies of the ones in the mock data, frauds are planted on top of them
+mock_data_path = os.path.join(os.path.dirname(__file__), "..", "mock_data", "fraud.json")
+
+# Payees the fake LLM treats as suspicious, so suspicious payee frauds can be planted and checked
+suspicious_payees = ["Beijing Electronics Co.", "Shanghai International", "Pyongyang Trading", "Moscow Wholesale LLC"]
+
+p2p_templates = [
+    { "description": "Zelle", "payee": "Money to Kevin", "memo": "Person-to-Person" },
+    { "description": "Venmo", "payee": "Venmo payment", "memo": "Rent split" },
+    { "description": "Cash App", "payee": "Cash App transfer", "memo": "Person-to-Person" }
+]
+
+# Transactions are spread over the year before the balance date
+history_seconds = 365 * 24 * 60 * 60
+
+def load_mock_account() -> dict:
+    with open(mock_data_path) as f:
+        return json.load(f)["accounts"][0]
+
+# Mock transactions that aren't themselves frauds, to base ordinary activity on
+def ordinary_templates(mock_account: dict) -> list[dict]:
+    suspicious = { payee.lower() for payee in suspicious_payees }
+    return [
+        t for t in mock_account["transactions"]
+        if t["payee"].lower() not in suspicious and t["description"] != "Zelle" and float(t["amount"]) > -1000
+    ]
+
+def make_transaction(transaction_id: str, posted: int, amount: float, template: dict, payee: str | None = None) -> dict:
+    return {
+        "id": transaction_id,
+        "posted": posted,
+        "amount": f"{amount:.2f}",
+        "description": template["description"],
+        "payee": payee or template["payee"],
+        "memo": template["memo"]
+    }
+
+planted_fraud_types = ["duplicate", "suspicious_payee", "large_p2p"]
+
+# Builds a SimpleFIN payload of about transaction_count transactions spread over account_count accounts
+# About fraud_rate of them are planted frauds, returned alongside as (fraud_type, [(account id, transaction id), ...])
+# Any non-zero fraud_rate plants at least one fraud of each type, so even the smallest histories have frauds to find
+# distinct_payees gives ordinary payees store numbers, as real payees vary far more than the mock data's few
+def generate_simplefin_data(transaction_count: int, account_count: int = 1, fraud_rate: float = 0.01,
+                            distinct_payees: int = 500, seed: int = 0) -> tuple[dict, list[tuple[str, list[tuple[str, str]]]]]:
+    rng = random.Random(seed)
+    mock_account = load_mock_account()
+    templates = ordinary_templates(mock_account)
+    balance_date = mock_account["balance-date"]
+    earliest = balance_date - history_seconds
+
+    accounts = []
+    for index in range(account_count):
+        account = copy.deepcopy({ key: value for key, value in mock_account.items() if key != "transactions" })
+        account["id"] = f"{mock_account['id']} {index}" if account_count > 1 else mock_account["id"]
+        account["name"] = f"{mock_account['name']} {index}" if account_count > 1 else mock_account["name"]
+        account["transactions"] = []
+        accounts.append(account)
+
+    fraud_count = max(len(planted_fraud_types), int(transaction_count * fraud_rate)) if fraud_rate > 0 else 0
+    ordinary_count = max(transaction_count - fraud_count, account_count)
+    for index in range(ordinary_count):
+        template = rng.choice(templates)
+        store_number = rng.randrange(max(distinct_payees // len(templates), 1))
+        account = accounts[index % account_count]
+        account["transactions"].append(make_transaction(
+            f"t{index}",
+            rng.randrange(earliest, balance_date),
+            float(template["amount"]) * rng.lognormvariate(0, 0.3),
+            template,
+            payee = f"{template['payee']} #{store_number}" if store_number else None
+        ))
+
+    # Plant the same number of each kind of fraud
+    planted: list[tuple[str, list[tuple[str, str]]]] = []
+    for index in range(fraud_count):
+        account = accounts[index % account_count]
+        fraud_type = planted_fraud_types[index % len(planted_fraud_types)]
+        transaction_id = f"f{index}"
+
+        if fraud_type == "duplicate":
+            # The same charge again shortly after, on another account if there is one
+            original = rng.choice(account["transactions"])
+            duplicate_account = accounts[(index + 1) % account_count]
+            duplicate = dict(original, id=transaction_id, posted=original["posted"] + rng.randrange(60, 6 * 60 * 60))
+            duplicate_account["transactions"].append(duplicate)
+            planted.append((fraud_type, [(account["id"], original["id"]), (duplicate_account["id"], transaction_id)]))
+        elif fraud_type == "suspicious_payee":
+            template = { "description": "Online shopping", "payee": rng.choice(suspicious_payees), "memo": "Electronics purchase" }
+            account["transactions"].append(make_transaction(
+                transaction_id, rng.randrange(earliest, balance_date), -rng.uniform(50, 5000), template
+            ))
+            planted.append((fraud_type, [(account["id"], transaction_id)]))
+        else:
+            account["transactions"].append(make_transaction(
+                transaction_id, rng.randrange(earliest, balance_date), -rng.uniform(150, 2500), rng.choice(p2p_templates)
+            ))
+            planted.append((fraud_type, [(account["id"], transaction_id)]))
+
+    for account in accounts:
+        rng.shuffle(account["transactions"])
+    return { "errors": [], "accounts": accounts }, planted
+
+# Share of the planted frauds of each type that were found, where a planted fraud is found if some reported
+# instance of the same type includes all of its transactions
+# Reported instances can be models or the JSON the API returns
+def planted_recall(planted: list[tuple[str, list[tuple[str, str]]]], possible_fraud_instances: list) -> dict[str, float]:
+    # Reported instances by (fraud type, transaction), so each planted fraud only checks the instances that could match
+    reported: dict[tuple, list[set]] = {}
+    for instance in possible_fraud_instances:
+        instance = instance if isinstance(instance, dict) else instance.model_dump()
+        keys = { (t["account_id"], t["id"]) for t in instance["transactions"] }
+        for key in keys:
+            reported.setdefault((instance["fraud_type"], key), []).append(keys)
+
+    found: dict[str, list[bool]] = {}
+    for fraud_type, transaction_keys in planted:
+        candidates = reported.get((fraud_type, transaction_keys[0]), [])
+        found.setdefault(fraud_type, []).append(any(set(transaction_keys) <= keys for keys in candidates))
+    return { fraud_type: sum(results) / len(results) for fraud_type, results in found.items() }